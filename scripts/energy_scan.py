@@ -0,0 +1,121 @@
+"""
+Base class for the scripts that run OPAL at each closed orbit energy (e.g.
+find_tune.py, find_dynamic_aperture.py); holds the closed orbits, lattice
+settings and temporary directories that they share
+"""
+
+import os
+import tempfile
+
+from opal_tracking import OpalTracking
+from opal_tracking import TrackingMetrics
+import xboa.common as common
+from xboa.hit import Hit
+from lattice_table import load_lattice_table
+
+class EnergyScan(object):
+    def __init__(self, closed_orbits_file_name, energy_min = None,
+                 energy_max = None, unique_id = None, name = "energy_scan"):
+        """
+        Initialise the settings shared by the energy scans.
+
+        - closed_orbits_file_name: name of a file containing closed orbits,
+                    generated by e.g. find_closed_orbits.py
+        - energy_min, energy_max: if both are not None, only energies in this
+                    range are used
+        - unique_id: labels the output files, plots and temporary directory,
+                    so that runs with different ids do not overwrite each
+                    other; if None, the process id is used
+        - name: names the temporary directory tmp/<name>/<unique_id>/
+        """
+        self.closed_orbits_cached = None # filled by _load_closed_orbits
+        self._load_closed_orbits(closed_orbits_file_name)
+        self.energy_min, self.energy_max = energy_min, energy_max
+        if unique_id == None:
+            unique_id = os.getpid()
+        self.unique_id = unique_id
+        self.name = name
+        self.tmp_dir = None # jobs use a new directory in here; see _temp_dir
+        self.opal = None # set by _find_opal
+        self.lattice_src = "lattices/KurriMainRingTuneComparison/"+\
+                           "KurriMainRingTuneComparison.in"
+        self.lattice = "/lattice.tmp"
+        self.beam_file = "/disttest.dat"
+        self.log_file = "/log"
+        self.output_filename = "PROBE*.loss"
+        self.nturns = 100.1
+        self.step_size = 10.
+        self.poly_order = 1
+        self.smooth_order = 1
+        # timings of lattice substitution and each OpalTracking phase; set
+        # metrics.metrics_filename to log every tracking call as json
+        self.metrics = TrackingMetrics()
+
+    def _find_opal(self):
+        """Set opal to the OPAL executable in ${OPAL_EXE_PATH}"""
+        self.opal = os.path.expandvars("${OPAL_EXE_PATH}/opal")
+        if "OPAL_EXE_PATH" in self.opal:
+            raise RuntimeError("${OPAL_EXE_PATH} environment variable "+\
+                "not set; should point to the directory where opal "+\
+                "executable is found.")
+
+    def _setup_tracking(self, energy, nturns, tmp_dir, metrics):
+        """
+        Make the lattice in tmp_dir; return an OpalTracking that runs OPAL in
+        tmp_dir, so that PROBE files are private to this job
+        """
+        with metrics.timer("substitute"):
+            common.substitute(
+                self.lattice_src,
+                tmp_dir+self.lattice, {
+                    "__energy__":energy,
+                    "__nturns__":nturns,
+                    "__beamfile__":tmp_dir+self.beam_file,
+                    "__stepsize__":self.step_size,
+                    "__poly_order__":self.poly_order,
+                    "__smooth_order__":self.smooth_order,
+            })
+        tracking = OpalTracking(tmp_dir+self.lattice,
+                                tmp_dir+self.beam_file,
+                                self._reference(energy),
+                                self.output_filename,
+                                self.opal,
+                                tmp_dir+self.log_file)
+        tracking.run_dir = tmp_dir
+        tracking.metrics = metrics
+        return tracking
+
+    def _temp_dir(self, energy):
+        """
+        Make a new temporary directory for one job, inside
+        tmp/<name>/<unique_id>/; returns its name, ending in "/"
+        """
+        self.tmp_dir = "tmp/"+self.name+"/"+str(self.unique_id)+"/"
+        try:
+            os.makedirs(self.tmp_dir)
+        except OSError:
+            pass
+        return tempfile.mkdtemp(prefix="energy="+str(energy)+"_",
+                                dir=self.tmp_dir)+"/"
+
+    def _energy_list(self):
+        """Sorted list of closed orbit energies between energy_min and max"""
+        energy_list = sorted(self.closed_orbits_cached.keys())
+        if self.energy_min != None and self.energy_max != None:
+            energy_list = [energy for energy in energy_list \
+                      if energy >= self.energy_min and energy <= self.energy_max]
+        return energy_list
+
+    def _load_closed_orbits(self, filename):
+        """Load closed orbit positions from a json file"""
+        self.closed_orbits_cached = load_lattice_table(filename).radius_dict()
+
+    def _reference(self, energy):
+        """Generate a reference particle"""
+        hit_dict = {}
+        hit_dict["pid"] = 2212
+        hit_dict["mass"] = common.pdg_pid_to_mass[2212]
+        hit_dict["charge"] = 1
+        hit_dict["x"] = 4600.
+        hit_dict["kinetic_energy"] = energy
+        return Hit.new_from_dict(hit_dict, "pz")
@@ -3,12 +3,20 @@ Script to find the tune; drives xboa EllipseClosedOrbitFinder algorithm
 """
 
 
+import math
 import numpy
 import sys
 import os
+import re
 import json
+import time
+import multiprocessing
 sys.path.insert(1, "scripts")
 from opal_tracking import OpalTracking
+from opal_tracking import TrackingMetrics
+from results_journal import ResultsJournal
+from lattice_table import LatticeTable
+from plot_queue import default_queue, wait_for_user
 import xboa.common as common
 from xboa.hit import Hit
 from xboa.algorithms.closed_orbit import EllipseClosedOrbitFinder
@@ -29,20 +37,28 @@ def reference(energy):
 
 def plot_iteration(i, iteration, energy, step, poly_order, smooth_order):
     """
-    Plot the closed orbit ellipse and the ellipse fit
+    Plot the closed orbit ellipse and the ellipse fit; the plot is rendered
+    by the default PlotQueue, so tracking does not wait for it
     """
-    canvas, hist, graph, fit = iteration.plot_ellipse("x", "px", "mm", "MeV/c")
-    hist.SetTitle('KE='+str(energy)+' iter='+str(i))
-    canvas.Update()
     name = "plots/closed_orbit-i_"+str(i)+"-ke_"+str(energy)+"-step_"+str(step)+"-po_"+str(poly_order)+"-so_"+str(smooth_order)
-    canvas.Print(name+".root")
-    canvas.Print(name+".png")
+    ellipse = None
+    if iteration.centre != None and getattr(iteration, "ellipse", None) != None:
+        ellipse = (iteration.centre, iteration.ellipse)
+    default_queue().scatter(name,
+                            [point[0] for point in iteration.points], "x [mm]",
+                            [point[1] for point in iteration.points],
+                            "p_{x} [MeV/c]",
+                            'KE='+str(energy)+' iter='+str(i), ellipse,
+                            ("root", "png"))
 
-def find_closed_orbit(energy, nturns, step, poly_order, smooth_order, seed):
+def find_closed_orbit(energy, nturns, step, poly_order, smooth_order, seed,
+                      metrics = None, tmp_dir = None, method = "ellipse",
+                      centre_tolerance = None, max_nturns = 80.1):
     """
     Find the closed orbit; algorithm is to track turn by turn; fit an ellipse to
     the tracking; find the centre of the ellipse; repeat until no improvement or
-    10 iterations.
+    10 iterations. Alternatively, if method is "newton", use newton_closed_orbit
+    (in which case nturns should be just over one turn, e.g. 1.1).
     - energy: (float) kinetic energy at which the co is calculated
     - step: (float) step size in tracking
     - poly_order: (int) order of the polynomial fit to the field map (not used)
@@ -50,9 +66,62 @@ def find_closed_orbit(energy, nturns, step, poly_order, smooth_order, seed):
                    (not used)
     - seed: (list of 2 floats) [x, px] value to be used as the seed for the next 
             iteration; px value is ignored, sorry about that.
+    - metrics: (TrackingMetrics) records the time spent substituting the
+               lattice and in each tracking phase; if None, a new one is made
+    - tmp_dir: (str) directory for lattice, beam, log and PROBE files; if None,
+               use tmp/find_closed_orbits/ with PROBE files in the current
+               directory. Set a unique tmp_dir to run several energies at once.
+    - method: (str) "ellipse" to use the xboa EllipseClosedOrbitFinder or
+              "newton" to use newton_closed_orbit
+    - centre_tolerance: (float) if not None, the ellipse finder stops
+               iterating once the fitted centre moves by less than
+               centre_tolerance [mm] in x from the seed of the iteration
+               (i.e. from the previous centre). If it has not converged
+               this well when it gives up (after 10 iterations, or when the
+               spread of the points grows), it is rerun from the last centre
+               with twice as many turns; each rerun starts a new set of
+               iterations. Ignored if method is "newton".
+    - max_nturns: (float) the number of turns is not doubled beyond this
+    Returns the list of hits tracked from the closed orbit.
     """
     print "Energy", energy, "NTurns", nturns, "StepSize", step, "Seed", seed, "Poly Order", poly_order, "Smooth Order", smooth_order
-    tmp_dir = "tmp/find_closed_orbits/"
+    if metrics == None:
+        metrics = TrackingMetrics()
+    while True:
+        tracking = _closed_orbit_tracking(energy, nturns, step, poly_order,
+                                          smooth_order, metrics, tmp_dir)
+        seed_hit = reference(energy)
+        seed_hit["x"] = seed[0]
+        if method == "newton":
+            seed_hit["px"] = seed[1]
+            return newton_closed_orbit(tracking, seed_hit)
+        centre, centre_shift = _ellipse_closed_orbit(tracking, seed_hit, energy,
+                                                     step, poly_order,
+                                                     smooth_order,
+                                                     centre_tolerance)
+        if centre_tolerance == None or centre_shift <= centre_tolerance:
+            break
+        # keep the fractional turn so that the last probe hit is recorded
+        next_nturns = round(2*int(nturns)+nturns-int(nturns), 6)
+        if next_nturns > max_nturns:
+            print "Centre shift", centre_shift, "mm but reached", \
+                  nturns, "turns"
+            break
+        print "Centre shift", centre_shift, "mm; rerunning with", \
+              next_nturns, "turns"
+        nturns = next_nturns
+        seed = centre
+    return tracking.last[0]
+
+def _closed_orbit_tracking(energy, nturns, step, poly_order, smooth_order,
+                           metrics, tmp_dir):
+    """
+    Write the lattice for energy and nturns and return an OpalTracking that
+    uses it; see find_closed_orbit for arguments
+    """
+    run_dir = tmp_dir
+    if tmp_dir == None:
+        tmp_dir = "tmp/find_closed_orbits/"
     try:
         os.makedirs(tmp_dir)
     except:
@@ -65,16 +134,29 @@ def find_closed_orbit(energy, nturns, step, poly_order, smooth_order, seed):
         '__smooth_order__':smooth_order,
         '__beamfile__':tmp_dir+'disttest.dat'
     }
-    common.substitute('lattices/KurriMainRingTuneComparison/KurriMainRingTuneComparison.in', tmp_dir+'/Kurri_ADS_Ring.tmp', subs)
+    with metrics.timer("substitute"):
+        common.substitute('lattices/KurriMainRingTuneComparison/KurriMainRingTuneComparison.in', tmp_dir+'/Kurri_ADS_Ring.tmp', subs)
     ref_hit = reference(energy)
     opal_exe = os.path.expandvars("${OPAL_EXE_PATH}/opal")
     tracking = OpalTracking(tmp_dir+'/Kurri_ADS_Ring.tmp', tmp_dir+'/disttest.dat', ref_hit, 'PROBE*.loss', opal_exe, tmp_dir+"/log")
-    mass = common.pdg_pid_to_mass[2212]
-    seed_hit = ref_hit.deepcopy()
-    seed_hit["x"] = seed[0]
+    tracking.metrics = metrics
+    tracking.run_dir = run_dir
+    return tracking
+
+def _ellipse_closed_orbit(tracking, seed_hit, energy, step, poly_order,
+                          smooth_order, centre_tolerance = None):
+    """
+    Run the xboa EllipseClosedOrbitFinder from seed_hit; returns a tuple of
+    the last [x, px] centre (or the last seed if no centre was found) and the
+    distance in x [mm] of that centre from the seed of its iteration, which
+    is the previous centre after the first iteration. If centre_tolerance is
+    not None, stop as soon as this distance is within centre_tolerance.
+    """
     finder = EllipseClosedOrbitFinder(tracking, seed_hit)
     generator = finder.find_closed_orbit_generator(["x", "px"], 1)
     x_std_old = 1e9
+    centre = [seed_hit["x"], seed_hit["px"]]
+    centre_shift = 1e9
     i = -1
     for i, iteration in enumerate(generator):
         print iteration.points
@@ -87,27 +169,340 @@ def find_closed_orbit(energy, nturns, step, poly_order, smooth_order, seed):
         x_mean = numpy.mean([point[0] for point in iteration.points])
         x_std = numpy.std([point[0] for point in iteration.points])
         print "Seed:", iteration.points[0][0], "Mean:", x_mean, "Std:", x_std
+        if iteration.centre != None:
+            centre = [iteration.centre[0], iteration.centre[1]]
+            centre_shift = abs(centre[0]-iteration.points[0][0])
+            if centre_tolerance != None and centre_shift <= centre_tolerance:
+                break
         if iteration.centre != None and x_std >= x_std_old: # require convergence
             break
         x_std_old = x_std
     if i > -1:
         plot_iteration(i, iteration, energy, step, poly_order, smooth_order)
+    return centre, centre_shift
 
-    return tracking.last[0]
+def newton_closed_orbit(tracking, seed_hit, deltas = (1., 0.1),
+                        tolerance = (1e-3, 1e-4), max_iterations = 10):
+    """
+    Find the closed orbit by Newton's method on the one turn map. Each
+    iteration tracks the seed and the seed displaced in x and px as one
+    multi-particle run; the transfer matrix J is estimated from the
+    displaced particles at the first station on turns 0 and 1, and the seed
+    is moved to the fixed point of the linearised map, u = (I-J)^-1 (u1-J u0).
+    - tracking: OpalTracking, with a lattice that tracks for at least one turn
+    - seed_hit: (Hit) first guess at the closed orbit
+    - deltas: (tuple of 2 floats) displacements in x [mm] and px [MeV/c]
+    - tolerance: (tuple of 2 floats) iteration stops when the seed moves by
+                 less than this in x [mm] and px [MeV/c] over one turn
+    - max_iterations: (int) maximum number of tracking runs
+    Returns the list of hits tracked from the final seed.
+    """
+    axes = ["x", "px"]
+    seed_hit = seed_hit.deepcopy()
+    for iteration in range(max_iterations):
+        hit_list = [seed_hit.deepcopy() for i in range(len(axes)+1)]
+        for i, axis in enumerate(axes):
+            hit_list[i+1][axis] += deltas[i]
+        track_list = tracking.track_many(hit_list)
+        if len(track_list) != len(hit_list):
+            raise RuntimeError("Lost particles while finding closed orbit")
+        u0, u1 = [], []
+        for track in track_list:
+            station = track.station_turn(0)[0]
+            u0.append([track[station, 0][axis] for axis in axes])
+            u1.append([track[station, 1][axis] for axis in axes])
+        u0, u1 = numpy.array(u0), numpy.array(u1)
+        residual = u1[0]-u0[0]
+        print "Newton iteration", iteration, "seed:", u0[0], \
+              "one turn residual:", residual
+        if numpy.all(numpy.abs(residual) < tolerance):
+            break
+        # transfer matrix from the displaced particles, relative to the seed
+        transfer = numpy.dot((u1[1:]-u1[0]).transpose(),
+                             numpy.linalg.inv((u0[1:]-u0[0]).transpose()))
+        fixed_point = numpy.linalg.solve(numpy.identity(len(axes))-transfer,
+                                         u1[0]-numpy.dot(transfer, u0[0]))
+        for i, axis in enumerate(axes):
+            seed_hit[axis] += fixed_point[i]-u0[0][i]
+    return track_list[0]
 
-if __name__ == "__main__":
-      next_seed = [4415., 0., 0.] # [5154.51, 0.0] # 
-      fout = open('find_closed_orbit.out', 'w')
-      energy_list = range(11, 12, 1)
-      for i, energy in enumerate(energy_list):
-          is_batch = len(energy_list) > 5 and i > 4
-          ROOT.gROOT.SetBatch(is_batch)
-          hit_list = find_closed_orbit(energy, 5.1, 10, 1, 1, next_seed)
-          next_seed = [hit_list[0]["x"], 0.]
-          output = [energy]+[[hit["x"], hit["t"]] for hit in hit_list]
-          print >> fout, json.dumps(output)
-          fout.flush()
-      if len(energy_list) < 5:
-          print "Finished"
-          raw_input()
+class SeedPredictor(object):
+    """
+    Predict the closed orbit radius at a new energy, for use as a seed. With
+    two or more converged orbits, a polynomial is fitted to the converged
+    orbits nearest in energy; with one, its radius is used; with none, the
+    r_closed_orbit polynomial from the lattice (if given) or default_seed.
+    """
+    def __init__(self, default_seed, lattice_filename = None, fit_order = 2):
+        """
+        Initialise the predictor
+        - default_seed: (float) radius to use before any orbits converge
+        - lattice_filename: (str) lattice containing an r_closed_orbit
+          polynomial in Edes [GeV]; if None, default_seed is used instead
+        - fit_order: (int) maximum order of the polynomial fit to converged
+          orbits
+        """
+        self.default_seed = default_seed
+        self.fit_order = fit_order
+        self.converged = {} # maps energy to closed orbit radius
+        self.lattice_polynomial = None
+        if lattice_filename != None:
+            lattice = open(lattice_filename).read()
+            match = re.search("r_closed_orbit\s*=([^;]*);", lattice)
+            self.lattice_polynomial = match.group(1).replace("^", "**")
+
+    def add(self, energy, radius):
+        """Add a converged closed orbit"""
+        self.converged[energy] = radius
+
+    def distance(self, energy):
+        """
+        Return the energy difference from energy to the nearest converged
+        orbit, or None if no orbits have converged
+        """
+        if len(self.converged) == 0:
+            return None
+        return min([abs(e-energy) for e in self.converged.keys()])
+
+    def predict(self, energy):
+        """Return the predicted closed orbit radius at energy"""
+        if len(self.converged) == 0:
+            if self.lattice_polynomial == None:
+                return self.default_seed
+            return eval(self.lattice_polynomial, {"__builtins__":{}},
+                        {"Edes":energy/1000.})
+        n_points = self.fit_order+2
+        nearest = sorted(self.converged.keys(),
+                         key = lambda e: abs(e-energy))[:n_points]
+        if len(nearest) == 1:
+            return self.converged[nearest[0]]
+        order = min(self.fit_order, len(nearest)-1)
+        radii = [self.converged[e] for e in nearest]
+        coefficients = numpy.polyfit(nearest, radii, order)
+        return float(numpy.polyval(coefficients, energy))
 
+def _sweep_job(args):
+    """
+    Find the closed orbit for one energy in its own tmp directory; returns a
+    tuple of energy and list of [x, t]. Runs in a worker process, or in this
+    process if there is only one worker.
+    """
+    energy, nturns, step, poly_order, smooth_order, seed, method, \
+                                                centre_tolerance, batch = args
+    ROOT.gROOT.SetBatch(batch)
+    tmp_dir = "tmp/find_closed_orbits/ke_"+str(energy)+"/"
+    hit_list = find_closed_orbit(energy, nturns, step, poly_order,
+                                 smooth_order, seed, tmp_dir=tmp_dir,
+                                 method=method,
+                                 centre_tolerance=centre_tolerance)
+    if multiprocessing.current_process().daemon:
+        default_queue().close() # pool workers exit without running atexit
+    return energy, [[hit["x"], hit["t"]] for hit in hit_list]
+
+def sweep_closed_orbits(energy_list, nturns, step, poly_order, smooth_order,
+                        predictor, output_filename, n_workers = None,
+                        method = "ellipse", journal = None,
+                        centre_tolerance = None, seed_distance = None):
+    """
+    Find closed orbits for many energies, n_workers at a time, each in its
+    own tmp directory. Seeds come from predictor, which is updated as each
+    energy converges; energies started before any nearby orbit has converged
+    are seeded from the lattice polynomial (or default seed) or from the fit
+    extrapolated from the orbits found so far. Each orbit is written to
+    output_filename as a json line [energy, [x, t], [x, t], ...] as soon as
+    it is found.
+
+    If seed_distance is set, an energy is only started once an orbit within
+    seed_distance of it has converged, so that its seed is fitted to nearby
+    orbits; energies are run one at a time until two orbits have converged,
+    and the sweep then fans out from them. If no energy is ready and nothing
+    is running, the pending energy nearest to a converged orbit is started
+    anyway. This gives better seeds but usually only a few energies run at
+    once, whatever n_workers is.
+    - energy_list: list of kinetic energies; energies are started in order
+    - nturns, step, poly_order, smooth_order: see find_closed_orbit
+    - predictor: SeedPredictor used to make seeds
+    - output_filename: name of the output file, or None for no output file
+    - n_workers: number of energies to run at once; if None, use the number
+      of CPUs. If 1, energies are run in this process.
+    - method: closed orbit finder; see find_closed_orbit
+    - journal: ResultsJournal, or None. Energies already in the journal with
+      the same parameters are not tracked again, but are used to seed the
+      remaining energies and are written to output_filename; new results are
+      appended to the journal as they are found.
+    - centre_tolerance: adaptive turn count target; see find_closed_orbit
+    - seed_distance: largest energy difference [MeV] between an energy and
+      the nearest converged orbit for the energy to be started, or None to
+      start energies as soon as a worker is free
+    Returns a dict mapping energy to list of [x, t].
+    """
+    if n_workers == None:
+        n_workers = multiprocessing.cpu_count()
+    fout = None
+    if output_filename != None:
+        fout = open(output_filename, 'w')
+    results = {}
+    def parameters(energy):
+        return {"energy":float(energy), "nturns":nturns, "step":step,
+                "poly_order":poly_order, "smooth_order":smooth_order,
+                "method":method, "centre_tolerance":centre_tolerance}
+    def store(energy, orbit):
+        predictor.add(energy, orbit[0][0])
+        results[energy] = orbit
+        if fout != None:
+            print >> fout, json.dumps([energy]+orbit)
+            fout.flush()
+        if journal != None and not journal.done(parameters(energy)):
+            journal.record(parameters(energy), orbit)
+    pending = []
+    for energy in energy_list:
+        if journal != None and journal.done(parameters(energy)):
+            print "Energy", energy, "found in", journal.file_name
+            store(energy, journal.get(parameters(energy)))
+        else:
+            pending.append(energy)
+    if n_workers == 1:
+        for i, energy in enumerate(pending):
+            is_batch = len(pending) > 5 and i > 4
+            seed = [predictor.predict(energy), 0.]
+            store(*_sweep_job((energy, nturns, step, poly_order,
+                               smooth_order, seed, method, centre_tolerance,
+                               is_batch)))
+        return results
+    pool = multiprocessing.Pool(n_workers)
+    running = {} # maps energy to AsyncResult
+    while len(pending) > 0 or len(running) > 0:
+        ready = _ready_energies(pending, running, predictor, seed_distance)
+        for energy in ready[:n_workers-len(running)]:
+            pending.remove(energy)
+            seed = [predictor.predict(energy), 0.]
+            args = (energy, nturns, step, poly_order, smooth_order, seed,
+                    method, centre_tolerance, True)
+            running[energy] = pool.apply_async(_sweep_job, (args,))
+        for energy, job in running.items():
+            if job.ready():
+                del running[energy]
+                store(*job.get())
+        time.sleep(0.1)
+    pool.close()
+    pool.join()
+    return results
+
+def _ready_energies(pending, running, predictor, seed_distance):
+    """
+    Return the pending energies that sweep_closed_orbits may start, in the
+    order they should be started; see sweep_closed_orbits for seed_distance
+    """
+    if seed_distance == None or len(pending) == 0:
+        return pending[:]
+    ready = [energy for energy in pending \
+             if predictor.distance(energy) != None and \
+                predictor.distance(energy) <= seed_distance]
+    if len(predictor.converged) < 2: # one at a time until seeds are fitted
+        ready = ready[:1]
+        if len(running) > 0:
+            ready = []
+    if len(ready) == 0 and len(running) == 0:
+        if predictor.distance(pending[0]) == None:
+            ready = [pending[0]]
+        else:
+            ready = [min(pending, key = predictor.distance)]
+    return ready
+
+def _interpolation_error(energy_list, value_list, index):
+    """
+    Estimate the error in linear interpolation of value_list at the midpoint
+    of energy_list[index] and energy_list[index+1], as the difference from a
+    cubic through the (up to) four nearest points. Returns None if there are
+    too few points to make an estimate.
+    """
+    first = max(0, min(index-1, len(energy_list)-4))
+    last = min(len(energy_list), first+4)
+    if last-first < 3:
+        return None
+    energies = energy_list[first:last]
+    values = value_list[first:last]
+    coefficients = numpy.polyfit(energies, values, len(energies)-1)
+    midpoint = (energy_list[index]+energy_list[index+1])/2.
+    linear = (value_list[index]+value_list[index+1])/2.
+    return abs(numpy.polyval(coefficients, midpoint)-linear)
+
+def adaptive_sweep_closed_orbits(energy_min, energy_max, coarse_step, nturns,
+                                 step, poly_order, smooth_order, predictor,
+                                 output_filename, radius_tolerance = 0.1,
+                                 tof_tolerance = 0.01, min_energy_step = 0.1,
+                                 max_points = 200, n_workers = None,
+                                 method = "ellipse", journal = None,
+                                 centre_tolerance = None, seed_distance = None):
+    """
+    Find closed orbits on an energy grid that is refined only where it is
+    needed. Start with a grid of coarse_step; then, for every interval where
+    the estimated error of linear interpolation in radius or mean time of
+    flight exceeds tolerance, add the midpoint energy and repeat. Each round
+    of new energies is run with sweep_closed_orbits. Radius and time of
+    flight are taken as in LatticeTable.from_closed_orbits, so orbits with
+    fewer than two distinct hit times are left out of the refinement.
+    - energy_min, energy_max: kinetic energy range [MeV]
+    - coarse_step: step of the initial energy grid [MeV]
+    - nturns, step, poly_order, smooth_order, predictor, n_workers, method,
+      journal, centre_tolerance: see sweep_closed_orbits
+    - seed_distance: see sweep_closed_orbits; e.g. coarse_step makes the
+      coarse grid fan out from neighbouring energies
+    - output_filename: name of the output file; rewritten in order of energy
+      after each round, in the same format as sweep_closed_orbits
+    - radius_tolerance: target interpolation error in radius [mm]
+    - tof_tolerance: target interpolation error in mean time of flight [ns]
+    - min_energy_step: intervals narrower than this are not split [MeV]
+    - max_points: stop refining when this many energies have been run
+    Returns a dict mapping energy to list of [x, t].
+    """
+    n_coarse = int(math.ceil((energy_max-energy_min)/coarse_step-1e-9))
+    new_energies = [energy_min+i*coarse_step for i in range(n_coarse)]
+    new_energies.append(energy_max)
+    results = {}
+    while len(new_energies) > 0:
+        print "Adaptive sweep running", len(new_energies), "new energies"
+        results.update(sweep_closed_orbits(new_energies, nturns, step,
+                                           poly_order, smooth_order, predictor,
+                                           None, n_workers, method, journal,
+                                           centre_tolerance, seed_distance))
+        fout = open(output_filename, 'w')
+        for energy in sorted(results.keys()):
+            print >> fout, json.dumps([energy]+results[energy])
+        fout.close()
+        table = LatticeTable.from_closed_orbits(
+                [[energy]+results[energy] for energy in sorted(results.keys())])
+        energy_list = table.energy_list
+        radius_list = table.radius_array.tolist()
+        tof_list = table.tof_array.tolist()
+        new_energies = []
+        for i in range(len(energy_list)-1):
+            if len(results)+len(new_energies) >= max_points:
+                break
+            if energy_list[i+1]-energy_list[i] < 2*min_energy_step:
+                continue
+            radius_error = _interpolation_error(energy_list, radius_list, i)
+            tof_error = _interpolation_error(energy_list, tof_list, i)
+            if radius_error == None or radius_error > radius_tolerance or \
+               tof_error > tof_tolerance:
+                midpoint = round((energy_list[i]+energy_list[i+1])/2., 6)
+                # an orbit already run but left out of the table (e.g. with
+                # too few hits) is not run again
+                if midpoint not in results:
+                    new_energies.append(midpoint)
+    return results
+
+def main():
+    """Find closed orbits over a range of energies"""
+    predictor = SeedPredictor(4415.) # 5154.51 #
+    energy_list = range(11, 12, 1)
+    n_workers = min(len(energy_list), multiprocessing.cpu_count())
+    journal = ResultsJournal('find_closed_orbit.journal')
+    sweep_closed_orbits(energy_list, 5.1, 10, 1, 1, predictor,
+                        'find_closed_orbit.out', n_workers, journal=journal)
+    if len(energy_list) < 5:
+        print "Finished"
+        wait_for_user()
+
+if __name__ == "__main__":
+    main()
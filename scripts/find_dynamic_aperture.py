@@ -0,0 +1,210 @@
+"""
+Script to find the dynamic aperture; for each energy and each direction in
+the (x, y) plane, search for the largest launch amplitude (measured from the
+closed orbit) at which particles survive nturns inside the aperture
+"""
+
+import json
+import math
+import shutil
+
+from opal_tracking import TrackingMetrics
+from opal_tracking import TrackingPool
+from energy_scan import EnergyScan
+from plot_queue import default_queue, wait_for_user
+
+class DynamicAperture(EnergyScan):
+    def __init__(self, closed_orbits_file_name, energy_min = None,
+                 energy_max = None, unique_id = None):
+        """
+        Find the dynamic aperture.
+
+        Each OPAL run tracks a particle on the closed orbit plus n_trials
+        particles in every unresolved direction, spread across the range of
+        amplitudes still in question; the range is narrowed from the results
+        (a generalised bisection) until it is smaller than tolerance. A
+        particle is lost if any hit has radius outside r_min to r_max or
+        |y| > y_max, or if it has fewer hits than the closed orbit particle.
+        OPAL is stopped early once every trial particle in a run is lost.
+
+        - closed_orbits_file_name: name of a file containing closed orbits,
+                    generated by e.g. find_closed_orbits.py
+        - energy_min, energy_max: if both are not None, only energies in this
+                    range are used
+        - unique_id: labels the output, plots and temporary directory; if
+                    None, the process id is used
+        """
+        EnergyScan.__init__(self, closed_orbits_file_name, energy_min,
+                            energy_max, unique_id, "dynamic_aperture")
+        self._find_opal()
+        self.lattice = "/DynamicAperture.tmp"
+        # directions [degrees] in the plane of x and y displacement; 0 is
+        # outwards in x, 90 is upwards in y and 180 is inwards in x
+        self.angle_list = [0., 45., 90., 135., 180.]
+        self.amplitude_max = 100. # [mm] largest amplitude searched
+        self.tolerance = 1. # [mm] stop when the aperture is known this well
+        self.n_trials = 4 # particles per direction per OPAL run
+        self.max_runs = 20 # OPAL runs per energy
+        self.r_min = 3900. # [mm] aperture
+        self.r_max = 5500. # [mm] aperture
+        self.y_max = 100. # [mm] aperture
+        self.poll_interval = 0.5 # [s] time between reads of PROBE files
+        self.n_workers = 1 # number of energies to run at once
+        self.plot_queue = default_queue()
+        self.string_id = "_nturns="+str(self.nturns)+"_stepsize="+\
+              str(self.step_size)+"_id="+str(self.unique_id)
+        self.output = "dynamic_aperture"+self.string_id+".out"
+
+    def find_dynamic_aperture(self):
+        """
+        Find the dynamic aperture at each energy, n_workers energies at a
+        time. Writes a json line to output for each energy, in order of
+        energy, holding "aperture": a list of [angle, amplitude_survived,
+        amplitude_lost] for each direction, where amplitude_lost is None if
+        particles survived at amplitude_max. Returns a list of the same.
+        """
+        fout = open(self.output, "w")
+        pool = None
+        if self.n_workers > 1:
+            pool = TrackingPool(self.n_workers)
+        pending = [] # list of (energy, job or result)
+        for energy in self._energy_list():
+            position = self.closed_orbits_cached[energy]
+            print "Finding dynamic aperture at", energy, "MeV and closed orbit x=", position, "mm"
+            if pool == None:
+                pending.append((energy, self._aperture_job(energy, position)))
+            else:
+                pending.append((energy, pool.submit(self._aperture_job,
+                                                    energy, position)))
+        results = []
+        for energy, job in pending:
+            if pool != None:
+                job = job.result()
+            aperture_info, metrics = job
+            self.metrics.merge(metrics)
+            self._plot_aperture(energy, aperture_info["aperture"])
+            print "Dynamic aperture at", energy, "MeV"
+            for angle, survived, lost in aperture_info["aperture"]:
+                print "   ", angle, "degrees:", survived, "to", lost, "mm"
+            print >> fout, json.dumps(aperture_info)
+            fout.flush()
+            results.append(aperture_info)
+        return results
+
+    def _aperture_job(self, energy, position):
+        """
+        Run the aperture search at one energy; returns a tuple of
+        (aperture_info, metrics)
+        """
+        metrics = TrackingMetrics(self.metrics.metrics_filename)
+        # [amplitude known to survive, amplitude known to be lost or
+        # amplitude_max, True if a loss has been seen] for each direction
+        brackets = [[0., self.amplitude_max, False] for angle in self.angle_list]
+        n_runs = 0
+        while n_runs < self.max_runs:
+            trials = [] # list of (direction index, amplitude)
+            for i, (survived, lost, is_lost) in enumerate(brackets):
+                if lost-survived <= self.tolerance:
+                    continue
+                if n_runs == 0: # include amplitude_max in the first run
+                    fractions = [(k+1.)/self.n_trials \
+                                                for k in range(self.n_trials)]
+                else:
+                    fractions = [(k+1.)/(self.n_trials+1.) \
+                                                for k in range(self.n_trials)]
+                for fraction in fractions:
+                    trials.append((i, survived+(lost-survived)*fraction))
+            if len(trials) == 0:
+                break
+            survival = self._track_trials(energy, position, trials, metrics)
+            n_runs += 1
+            for (i, amplitude), survives in zip(trials, survival):
+                if not survives and amplitude <= brackets[i][1]:
+                    brackets[i][1] = amplitude
+                    brackets[i][2] = True
+            for (i, amplitude), survives in zip(trials, survival):
+                if survives and brackets[i][0] < amplitude < brackets[i][1]:
+                    brackets[i][0] = amplitude
+                elif survives and amplitude == self.amplitude_max:
+                    brackets[i][0] = amplitude
+        aperture = []
+        for angle, (survived, lost, is_lost) in zip(self.angle_list, brackets):
+            if not is_lost:
+                lost = None
+            aperture.append([angle, survived, lost])
+        aperture_info = {
+            "energy":energy,
+            "closed_orbit":position,
+            "nturns":self.nturns,
+            "stepsize":self.step_size,
+            "n_runs":n_runs,
+            "aperture":aperture,
+        }
+        return aperture_info, metrics
+
+    def _track_trials(self, energy, position, trials, metrics):
+        """
+        Track a particle on the closed orbit and one particle for each
+        (direction index, amplitude) in trials, in a single OPAL run; returns
+        a list of booleans, True for each trial particle that survived
+        """
+        hit_list = [self._reference(energy)]
+        hit_list[0]["x"] = position
+        for i, amplitude in trials:
+            angle = math.radians(self.angle_list[i])
+            hit = self._reference(energy)
+            hit["x"] = position+amplitude*math.cos(angle)
+            hit["y"] += amplitude*math.sin(angle)
+            hit_list.append(hit)
+        lost_events = set()
+        def stop_condition(hit, track):
+            if self._outside_aperture(hit):
+                lost_events.add(hit["event_number"])
+            return len(lost_events-set([0])) == len(trials)
+        tmp_dir = self._temp_dir(energy)
+        tracking = self._setup_tracking(energy, self.nturns, tmp_dir, metrics)
+        tracking.track_many_until(hit_list, stop_condition, self.poll_interval)
+        try:
+            shutil.rmtree(tmp_dir)
+        except OSError:
+            pass
+        track_dict = dict([(track[0]["event_number"], track) \
+                                 for track in tracking.last if len(track) > 0])
+        n_hits = len(track_dict.get(0, []))
+        survival = []
+        for event in range(1, len(hit_list)):
+            track = track_dict.get(event, [])
+            survives = len(track) >= n_hits and len(track) > 0 and \
+                       event not in lost_events and \
+                       not any([self._outside_aperture(hit) for hit in track])
+            survival.append(survives)
+        return survival
+
+    def _outside_aperture(self, hit):
+        """Return True if hit is outside the aperture"""
+        return hit["x"] < self.r_min or hit["x"] > self.r_max or \
+               abs(hit["y"]) > self.y_max
+
+    def _plot_aperture(self, energy, aperture):
+        """Send the largest surviving launch positions to plot_queue"""
+        x_list = [survived*math.cos(math.radians(angle)) \
+                                         for angle, survived, lost in aperture]
+        y_list = [survived*math.sin(math.radians(angle)) \
+                                         for angle, survived, lost in aperture]
+        name = "plots/dynamic_aperture_energy="+str(energy)+self.string_id
+        self.plot_queue.scatter(name, x_list, "x - x_{co} [mm]", y_list,
+                                "y [mm]", "dynamic aperture KE="+str(energy),
+                                formats=("png", "root"))
+
+def main():
+    aperture = DynamicAperture(
+                "lattices/KurriMainRingTuneComparison/closed_orbits.ref",
+                10.99,
+                15.01)
+    aperture.n_workers = 5
+    aperture.find_dynamic_aperture()
+
+if __name__ == "__main__":
+    main()
+    print "Finished"
+    wait_for_user()
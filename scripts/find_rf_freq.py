@@ -1,10 +1,11 @@
 """Script to calculate RF frequency for a fixed accelerating phase"""
 
-import bisect
-import json
 import math
-import ROOT
-import xboa.common
+import re
+import sys
+import numpy
+from lattice_table import load_lattice_table
+from plot_queue import wait_for_user
 
 class FrequencyFinder(object):
     """
@@ -12,7 +13,8 @@ class FrequencyFinder(object):
     voltage and phase.
     
     Time-of-flight around the ring is based on output from the closed orbit
-    finder, with linear interpolation between points
+    finder, with monotone cubic interpolation between points (see
+    lattice_table)
     """
     def __init__(self, co_filename, energy_0, energy_1, voltage, phase):
         """
@@ -27,17 +29,25 @@ class FrequencyFinder(object):
         self.energy_list = []
         self.time_list = []
         self.freq_list = []
+        self.energy_0, self.energy_1 = None, None # set by get_frequency
+        self.voltage, self.phase = None, None # set by get_frequency
+        self.coefficients = None # set by fit_frequency
+        self.phase_residual = None # set by fit_frequency
         self.closed_orbits_t = {}
         self.closed_orbits_x = {}
+        self.lattice_table = None # set by _load_closed_orbits
         self._load_closed_orbits(co_filename)
         #self._test_get_a_freq()
         self.get_frequency(energy_0, energy_1, voltage, phase)
 
     def plot_frequency(self):
         """
-        Plot the frequency with time; fit 4th order polynomial (to be fed into
-        the RF polynomial_time_dependence)
+        Plot the frequency with time, and the polynomial from fit_frequency
+        (fitting a 4th order polynomial if there is no fit yet)
         """
+        import xboa.common # ROOT is only needed for plotting
+        if self.coefficients == None:
+            self.fit_frequency()
         canvas = xboa.common.make_root_canvas("frequency vs time")
         canvas.Draw()
         freq_list = [freq for freq in self.freq_list]
@@ -46,11 +56,104 @@ class FrequencyFinder(object):
                                                   freq_list, "f [GHz]")
         hist.Draw()
         graph.Draw("sameL")
-        fit = ROOT.TF1("fit", "pol4", 0, 20*1e6)
-        fit.FixParameter(0, freq_list[0])
-        graph.Fit(fit)
+        fit_list = numpy.polyval(self.coefficients[::-1],
+                                 numpy.array(self.time_list)).tolist()
+        hist, fit_graph = xboa.common.make_root_graph("fit", self.time_list,
+                                                      "time [ns]", fit_list,
+                                                      "f [GHz]")
+        fit_graph.SetLineColor(2)
+        fit_graph.Draw("sameL")
         canvas.Update()
 
+    def fit_frequency(self, order = 4, phase_tolerance = None):
+        """
+        Fit a polynomial f(t) = P0 + P1 t + ... + Pn t^n to the frequency
+        program, with P0 fixed to the start frequency (as for the RF
+        POLYNOMIAL_TIME_DEPENDENCE). The RF cavity phase is 2 pi f(t) t, so
+        the fit minimises the phase residual 2 pi t (f(t) - f) on each turn,
+        rather than the frequency residual.
+        - order: order of the polynomial
+        - phase_tolerance: if not None, raise a ValueError if the largest
+          phase residual [rad] is bigger than phase_tolerance
+        Returns the list of coefficients [P0, P1, ...]; the coefficients and
+        the array of phase residuals are also stored in coefficients and
+        phase_residual
+        """
+        time_array = numpy.array(self.time_list)
+        freq_array = numpy.array(self.freq_list)
+        # scale time to 0 to 1 so that the least squares problem is well
+        # conditioned
+        time_scale = max(time_array[-1], 1.)
+        powers = numpy.arange(1, order+1)
+        design = (time_array[:, numpy.newaxis]/time_scale)**powers
+        weight = 2.*math.pi*time_array[:, numpy.newaxis]
+        solution = numpy.linalg.lstsq(design*weight,
+                                  (freq_array-freq_array[0])*weight[:, 0],
+                                  rcond=None)[0]
+        coefficients = [freq_array[0]]+(solution/time_scale**powers).tolist()
+        fit_array = freq_array[0]+numpy.dot(design, solution)
+        self.coefficients = coefficients
+        self.phase_residual = 2.*math.pi*time_array*(fit_array-freq_array)
+        max_residual = numpy.max(numpy.abs(self.phase_residual))
+        print "Fitted order", order, "polynomial", coefficients
+        print "Largest phase residual", max_residual, "rad"
+        if phase_tolerance != None and max_residual > phase_tolerance:
+            raise ValueError("RF frequency fit has phase residual "+\
+                             str(max_residual)+" rad, greater than tolerance "+\
+                             str(phase_tolerance)+" rad")
+        return coefficients
+
+    def write_lattice(self, template_filename, lattice_filename,
+                      frequency_element = "rf_frequency",
+                      amplitude_element = "rf_amplitude"):
+        """
+        Write an acceleration lattice for the RF program, by copying the
+        template lattice with these values replaced:
+        - Edes: energy_0 [GeV]
+        - n_turns: number of turns in the RF program
+        - the P coefficients of the frequency_element
+          POLYNOMIAL_TIME_DEPENDENCE: coefficients, from fit_frequency
+        - the P0 coefficient of the amplitude_element
+          POLYNOMIAL_TIME_DEPENDENCE: voltage divided by the length L of the
+          VARIABLE_RF_CAVITY [MV/m]
+        Values are written at full precision. Raises a ValueError if one of
+        the values is not found in the template.
+        """
+        if self.coefficients == None:
+            raise ValueError("Call fit_frequency before write_lattice")
+        lattice = open(template_filename).read()
+        match = re.search("VARIABLE_RF_CAVITY\s*,[^;]*?\\bL\s*=\s*([^,;]+)",
+                          lattice, re.I)
+        if match == None:
+            raise ValueError("No VARIABLE_RF_CAVITY length in "+\
+                             template_filename)
+        cavity_length = float(match.group(1)) # [mm]
+        frequency = ", ".join(["P"+str(i)+"="+repr(coefficient) \
+                               for i, coefficient in enumerate(self.coefficients)])
+        amplitude = "P0="+repr(self.voltage/cavity_length*1e3)
+        replacements = [
+            ("^(\s*Edes\s*=)[^;]*;", "\g<1>"+repr(self.energy_0/1e3)+";"),
+            ("^(\s*n_turns\s*=)[^;]*;",
+                            "\g<1>"+repr(len(self.time_list)-1+0.001)+";"),
+            ("^(\s*"+frequency_element+\
+             "\s*:\s*POLYNOMIAL_TIME_DEPENDENCE\s*,)[^;]*;",
+                                                 "\g<1> "+frequency+";"),
+            ("^(\s*"+amplitude_element+\
+             "\s*:\s*POLYNOMIAL_TIME_DEPENDENCE\s*,)[^;]*;",
+                                                 "\g<1> "+amplitude+";"),
+        ]
+        for pattern, replacement in replacements:
+            lattice, n_subs = re.subn(pattern, replacement, lattice,
+                                      flags=re.M | re.I)
+            if n_subs != 1:
+                raise ValueError("Expected to find "+pattern+" once in "+\
+                                 template_filename+"; found it "+\
+                                 str(n_subs)+" times")
+        fout = open(lattice_filename, "w")
+        fout.write(lattice)
+        fout.close()
+        print "Wrote lattice", lattice_filename
+
     def get_frequency(self, energy_0, energy_1, voltage, phase):
         """
         Get the frequency
@@ -60,17 +163,17 @@ class FrequencyFinder(object):
         - phase: fixed synchronous phase with time
         Returns a tuple of (time_list, frequency_list)
         """
-        energy = energy_0
-        time_list = [0.]
-        freq_list = [self._get_a_freq(energy)]
-        
-        while energy < energy_1:
-            frequency = self._get_a_freq(energy)
-            time = time_list[-1]+1./frequency
-            time_list.append(time)
-            freq_list.append(frequency)
-            energy += voltage*math.sin(phase)
-            #print energy, frequency, time
+        energy_step = numpy.array([voltage*math.sin(phase)])
+        n_turns = self._n_turns(energy_0, energy_1, energy_step)
+        energy_list = self._turn_energies(energy_0, energy_step, n_turns)[0]
+        frequency = self._get_frequencies(energy_list[:n_turns[0]])
+        time_list = numpy.cumsum(numpy.concatenate(([0.], 1./frequency)))
+        freq_list = numpy.concatenate(([self._get_a_freq(energy_0)],
+                                       frequency))
+        time_list, freq_list = time_list.tolist(), freq_list.tolist()
+        self.energy_0, self.energy_1 = energy_0, energy_1
+        self.voltage, self.phase = voltage, phase
+        self.coefficients, self.phase_residual = None, None
         print "Found frequencies for energy ", energy_0, "to", energy_1, "MeV"
         print "RF running with", voltage, "MV/turn and", \
               math.degrees(phase), "degrees"
@@ -81,24 +184,109 @@ class FrequencyFinder(object):
         self.freq_list = freq_list
         return time_list, freq_list
 
+    def scan_rf_parameters(self, energy_0, energy_1, voltage_list,
+                           phase_list, max_elements = 10000000):
+        """
+        Calculate the RF program for every combination of voltage and phase,
+        without printing or storing the program
+        - energy_0: start energy for the frequency calculation
+        - energy_1: final energy for the frequency calculation
+        - voltage_list: list of voltages per turn
+        - phase_list: list of synchronous phases
+        - max_elements: settings are calculated in blocks with at most this
+          many turns in total (or one setting, if it needs more turns), to
+          limit memory use; turns are counted block by block too
+        Returns a dict of arrays with shape (len(voltage_list),
+        len(phase_list)): "voltage", "phase", "n_turns", "cycle_time" (time
+        at the end of the last turn), "frequency_start" and "frequency_end"
+        (frequency on the first and last turn)
+        """
+        voltage, phase = numpy.meshgrid(numpy.array(voltage_list, dtype=float),
+                                        numpy.array(phase_list, dtype=float),
+                                        indexing="ij")
+        energy_step = (voltage*numpy.sin(phase)).flatten()
+        max_turns = self._max_turns(energy_0, energy_1, energy_step)
+        n_turns = numpy.zeros(energy_step.shape, dtype=int)
+        cycle_time = numpy.zeros(energy_step.shape)
+        frequency_start = numpy.zeros(energy_step.shape)
+        frequency_end = numpy.zeros(energy_step.shape)
+        start = 0
+        while start < len(energy_step):
+            end = start+1
+            while end < len(energy_step) and \
+                  numpy.max(max_turns[start:end+1])*(end+1-start) <= max_elements:
+                end += 1
+            energy = self._turn_energies(energy_0, energy_step[start:end],
+                                         max_turns[start:end])
+            n_turns[start:end] = numpy.sum(energy < energy_1, axis=1)
+            frequency = self._get_frequencies(energy)
+            in_cycle = numpy.arange(energy.shape[1]) < \
+                                          n_turns[start:end, numpy.newaxis]
+            period = numpy.where(in_cycle, 1./frequency, 0.)
+            cycle_time[start:end] = numpy.sum(period, axis=1)
+            frequency_start[start:end] = frequency[:, 0]
+            rows = numpy.arange(end-start)
+            frequency_end[start:end] = \
+                           frequency[rows, numpy.maximum(n_turns[start:end]-1, 0)]
+            start = end
+        shape = voltage.shape
+        return {
+            "voltage":voltage,
+            "phase":phase,
+            "n_turns":n_turns.reshape(shape),
+            "cycle_time":cycle_time.reshape(shape),
+            "frequency_start":frequency_start.reshape(shape),
+            "frequency_end":frequency_end.reshape(shape),
+        }
+
+    def _n_turns(self, energy_0, energy_1, energy_step):
+        """
+        Number of turns to go from energy_0 to at least energy_1 for each
+        energy gain per turn in the array energy_step
+        """
+        # energy is accumulated turn by turn, with rounding errors, so count
+        # the turns that really start below energy_1
+        max_turns = self._max_turns(energy_0, energy_1, energy_step)
+        energy = self._turn_energies(energy_0, energy_step, max_turns)
+        return numpy.sum(energy < energy_1, axis=1)
+
+    def _max_turns(self, energy_0, energy_1, energy_step):
+        """
+        Upper bound on the number of turns to go from energy_0 to at least
+        energy_1 for each energy gain per turn in the array energy_step,
+        allowing for rounding errors as energy is accumulated
+        """
+        if numpy.any(energy_step <= 0.):
+            raise ValueError("Energy gain per turn must be positive")
+        n_turns = numpy.ceil((energy_1-energy_0)/energy_step).astype(int)
+        return numpy.maximum(n_turns, 0)+2
+
+    def _turn_energies(self, energy_0, energy_step, n_turns):
+        """
+        Energy at the start of each turn for each energy gain per turn in the
+        array energy_step, accumulated turn by turn (so that rounding matches
+        energy += energy_step). Returns an array of shape (len(energy_step),
+        max(n_turns)); shorter rows continue past their last turn.
+        """
+        steps = numpy.empty((len(energy_step), max(numpy.max(n_turns), 1)))
+        steps[:] = energy_step[:, numpy.newaxis]
+        steps[:, 0] = energy_0
+        return numpy.cumsum(steps, axis=1)
+
+    def _get_frequencies(self, energy):
+        """
+        Get RF frequencies (1/time of flight) for an array of energies using
+        monotone cubic interpolation between closed orbits, and linear
+        extrapolation (along the end slope) beyond the first and last closed
+        orbit
+        """
+        return self.lattice_table.frequency(energy)
+
     def _get_a_freq(self, energy):
         """
-        Get a RF frequency (1/time of flight) for energy using linear
-        interpolation
-        """
-        left_index = bisect.bisect_left(self.energy_list, energy)
-        if left_index+1 >= len(self.energy_list):
-            left_index = len(self.energy_list)-2
-        elif left_index > 0:
-            left_index -= 1
-        energy0 = self.energy_list[left_index]
-        energy1 = self.energy_list[left_index+1]
-        freq0 = 1./self.closed_orbits_t[energy0]
-        freq1 = 1./self.closed_orbits_t[energy1]
-        frequency = (freq1 - freq0)/(energy1-energy0)*(energy-energy0) + freq0
-        #print "\nl:", left_index, "e0:", energy0, "e1:", energy1, \
-        #      "f0:", freq0, "f1:", freq1, "DE:", energy-e0, "f", frequency
-        return frequency
+        Get a RF frequency (1/time of flight) for energy by interpolation
+        """
+        return float(self._get_frequencies(numpy.array([energy]))[0])
 
     def _test_get_a_freq(self):
         """Test the _get_a_freq function"""
@@ -118,37 +306,50 @@ class FrequencyFinder(object):
 
 
     def _load_closed_orbits(self, filename):
-        """Load closed orbits from a json file"""
-        fin = open(filename)
-        closed_orbits = [json.loads(line) for line in fin.readlines()]
-        self._get_x(closed_orbits)
-        self._get_t(closed_orbits)
-        self.energy_list = sorted(self.closed_orbits_t.keys())
-
-    def _get_x(self, closed_orbits):
-        """Load the position info from the closed orbit data"""
-        closed_orbits_energy = [orbit[0] for orbit in closed_orbits]
-        closed_orbits_x = [orbit[1:][0][0] for orbit in closed_orbits]
-        closed_orbits_x_dict = dict(zip(closed_orbits_energy, closed_orbits_x))
-        self.closed_orbits_x = closed_orbits_x_dict
-
-    def _get_t(self, closed_orbits):
-        """Load the time info from the closed orbit data"""
-        self.closed_orbits_t = {}
-        for orbit in closed_orbits:
-            delta_t = orbit[1:][-1][1] - orbit[1:][0][1]
-            mean_t = delta_t/(len(orbit[1:])-1)
-            energy = orbit[0]
-            self.closed_orbits_t[energy] = mean_t
+        """
+        Load closed orbit positions and mean time of flight from a json file
+        """
+        self.lattice_table = load_lattice_table(filename)
+        self.closed_orbits_x = self.lattice_table.radius_dict()
+        self.closed_orbits_t = self.lattice_table.tof_dict()
+        self.energy_list = self.lattice_table.energy_list
 
 def main():
-    """Main function"""
+    """
+    Main function; fit the RF program and write the acceleration lattice.
+    Command line options:
+    - --batch: skip the plot (and so ROOT)
+    - --order=<n>: order of the frequency polynomial (default 4)
+    - --phase-tolerance=<rad>: largest allowed phase residual of the fit
+      (default 0.1); if the fit is worse, no lattice is written and the
+      script exits with status 1 (after showing the plot, unless --batch)
+    """
+    options = {"--order":"4", "--phase-tolerance":"0.1"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            key, value = arg.split("=", 1)
+            options[key] = value
     finder = FrequencyFinder(
                   "lattices/KurriMainRingTuneComparison/closed_orbits.ref",
                   11., 150., 4.e-3, math.radians(30),
              )
-    finder.plot_frequency()
-    raw_input()
+    fit_ok = True
+    try:
+        finder.fit_frequency(int(options["--order"]),
+                             float(options["--phase-tolerance"]))
+    except ValueError as error:
+        print "Not writing the lattice:", error
+        fit_ok = False
+    if fit_ok:
+        finder.write_lattice(
+          "lattices/KurriMainRingWithAcceleration/KurriMainRingWithAcceleration.in",
+          "lattices/KurriMainRingWithAcceleration/"+\
+                                     "KurriMainRingWithAcceleration_fitted.in")
+    if "--batch" not in sys.argv[1:]:
+        finder.plot_frequency()
+        wait_for_user()
+    if not fit_ok:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,28 @@
 """
 Script to find the tune; drives xboa DPhiTuneFinder (FFT was making large side
-bands which looked non-physical)
+bands which looked non-physical) or, if Tune.tune_finder is set, the windowed
+FFT, NAFF or dphi routines in tune_analysis
 """
 
 import glob
 import json
 import sys
 import math
-import os
 import shutil
+import numpy
 import ROOT
-from opal_tracking import OpalTracking
-import xboa.common as common
-from xboa.hit import Hit
+from opal_tracking import StoredTracking
+from opal_tracking import TrackingMetrics
+from opal_tracking import TrackingPool
+from results_journal import ResultsJournal
+import tune_analysis
+from energy_scan import EnergyScan
+from plot_queue import default_queue, wait_for_user
 from xboa.algorithms.tune import FFTTuneFinder
 from xboa.algorithms.tune import DPhiTuneFinder
 
-class Tune(object):
-    def __init__(self, probe_file_name, closed_orbits_file_name, energy_min = None, energy_max = None):
+class Tune(EnergyScan):
+    def __init__(self, probe_file_name, closed_orbits_file_name, energy_min = None, energy_max = None, unique_id = None):
         """
         Find the tune. 
 
@@ -27,40 +32,48 @@ class Tune(object):
                     tracking.
         -closed_orbits_file_name: name of a file containing closed orbits,
                     generated by e.g. 
+        -unique_id: labels the output files, plots and temporary directory, so
+                    that runs with different ids do not overwrite each other;
+                    if None, the process id is used. Use the same id to
+                    resume a run from its journal.
         """
-        self.closed_orbits_cached = None # filled by _load_closed_orbits
-        self.tmp_dir = None
-        self.unique_id = 2
+        EnergyScan.__init__(self, closed_orbits_file_name, energy_min,
+                            energy_max, unique_id, "tune")
         self.just_plot = probe_file_name != None
         if self.just_plot:
             self.opal = "/bin/echo" # disables the tune calculation
+            self.output_filename = probe_file_name
         else:
-            self.opal = os.path.expandvars("${OPAL_EXE_PATH}/opal")
-            if "OPAL_EXE_PATH" in self.opal:
-                raise RuntimeError("${OPAL_EXE_PATH} environment variable "+\
-                    "not set; should point to the directory where opal "+\
-                    "executable is found.")
-        self.lattice_src = "lattices/KurriMainRingTuneComparison/"+\
-                           "KurriMainRingTuneComparison.in"
+            self._find_opal()
         self.lattice = "/Tune.tmp"
-        self.beam_file = "/disttest.dat"
-        self.log_file = "/log"
-        if self.just_plot:
-            self.output_filename = file_name
-        else:
-            self.output_filename = "PROBE*.loss"
-        self._load_closed_orbits(closed_orbits_file_name)
-        self.nturns = 100.1
-        self.step_size = 10.
-        self.poly_order = 1
-        self.smooth_order = 1
         self.delta_x = 1.
         self.delta_y = 1.
+        # if True, track all axes (and amplitudes) in one OPAL run
+        self.single_run = False
+        self.amplitude_list = [1.] # multiples of delta_x, delta_y to track
+        # if not None, nturns is doubled (up to max_nturns) and the energy
+        # rerun until every tune_error is below tune_tolerance
+        self.tune_tolerance = None
+        self.max_nturns = 800.1
+        # ResultsJournal or None; energies already in the journal (with the
+        # same run parameters) are not tracked again
+        self.journal = None
+        # phase space plots are sent to plot_queue, to be rendered away from
+        # the tracking loop
+        self.plot_queue = default_queue()
+        # None to use xboa DPhiTuneFinder, or one of tune_analysis.METHODS
+        # to analyse all tracks from a run together with numpy
+        self.tune_finder = None
+        # number of tracking jobs to run at once
+        self.n_workers = 1
         self.string_id = "_nturns="+str(self.nturns)+"_stepsize="+\
               str(self.step_size)+"_poly_order="+str(self.poly_order)+\
               "_smooth_order="+str(self.smooth_order)+"_id="+str(self.unique_id)
         self.output = "tunes"+self.string_id+".out"
-        self.energy_min, self.energy_max = energy_min, energy_max
+        # amplitude grid [mm] and output file for find_tune_footprint
+        self.footprint_x_amplitudes = [1., 5., 10., 20.]
+        self.footprint_y_amplitudes = [1., 5., 10., 20.]
+        self.footprint_output = "tune_footprint"+self.string_id+".out"
 
     def find_tune_dphi(self):
         """
@@ -68,112 +81,423 @@ class Tune(object):
         done by evolving turn-by-turn the track; calculating a matched ellipse
         by looking at tracking output; transforming the ellipse into a circle
         using LU decomposition; then calculating the angle advanced.
+
+        If single_run is True, the x and y displaced particles (for each
+        amplitude in amplitude_list) are tracked together in one OPAL run and
+        each DPhiTuneFinder is fed its own track.
+
+        If tune_tolerance is set, each energy is tracked for nturns and then
+        rerun with twice as many turns while the tune error is too large.
+
+        If journal is set, results for energies already in the journal are
+        copied to the output without tracking and new results are recorded.
+
+        If n_workers is more than 1, up to n_workers tracking jobs (one per
+        energy, or per energy and axis if single_run is False) run at once;
+        results are written to the output in order of energy.
         """
         fout = open(self.output, "w")
-        index = 0
-        for energy, position in sorted(self.closed_orbits_cached.iteritems()):
-            if self.energy_min != None and self.energy_max != None:
-                if energy < self.energy_min or energy > self.energy_max:
-                    continue
-            index += 1
-            if index > 2:
+        energy_list = self._energy_list()
+        if self.single_run:
+            axes_list = [("x", "y")]
+        else:
+            axes_list = [("x",), ("y",)]
+        pool = None
+        if self.n_workers > 1:
+            pool = TrackingPool(self.n_workers)
+        pending = [] # list of (energy, parameters, list of jobs or None)
+        for index, energy in enumerate(energy_list):
+            if index > 1:
                 ROOT.gROOT.SetBatch(True)
-            print "Finding tune at", energy, "MeV and closed orbit x=", position, "mm"
-            self.co_x = position
+            position = self.closed_orbits_cached[energy]
+            parameters = self._journal_parameters(energy)
+            if self.journal != None and self.journal.done(parameters):
+                print "Tune at", energy, "MeV found in", self.journal.file_name
+                pending.append((energy, parameters, None))
+            elif pool == None:
+                print "Finding tune at", energy, "MeV and closed orbit x=", position, "mm"
+                self.co_x = position
+                pending.append((energy, parameters,
+                                [self._tune_job(energy, position, axes) \
+                                                      for axes in axes_list]))
+            else:
+                print "Queueing tune at", energy, "MeV and closed orbit x=", position, "mm"
+                pending.append((energy, parameters,
+                                [pool.submit(self._tune_job, energy, position,
+                                             axes) for axes in axes_list]))
+            if pool == None:
+                self._write_tune(fout, *pending.pop())
+        for energy, parameters, job_list in pending:
+            if job_list != None:
+                job_list = pool.gather(job_list)
+            self._write_tune(fout, energy, parameters, job_list)
+
+    def find_tune_footprint(self):
+        """
+        Scan the tune against amplitude. At each energy, one particle for
+        every pair of amplitudes in footprint_x_amplitudes and
+        footprint_y_amplitudes (displacements from the closed orbit in mm)
+        is tracked in a single OPAL run, and the x and y tunes of all the
+        particles are found together with tune_analysis, using tune_finder
+        (or "naff" if tune_finder is None). Up to n_workers energies run at
+        once. A json line is written to footprint_output for each energy,
+        holding
+        - "footprint": list of [x_amplitude, y_amplitude, x_tune,
+          x_tune_error, y_tune, y_tune_error] for every particle
+        - "x_detuning": list of [x_amplitude, x_tune, y_tune] for particles
+          at the smallest y amplitude
+        - "y_detuning": list of [y_amplitude, x_tune, y_tune] for particles
+          at the smallest x amplitude
+        Tunes of lost particles are None.
+        """
+        fout = open(self.footprint_output, "w")
+        pool = None
+        if self.n_workers > 1:
+            pool = TrackingPool(self.n_workers)
+        pending = [] # list of (energy, job or result)
+        for index, energy in enumerate(self._energy_list()):
+            position = self.closed_orbits_cached[energy]
+            print "Finding tune footprint at", energy, "MeV and closed orbit x=", position, "mm"
+            if pool == None:
+                pending.append((energy, self._footprint_job(energy, position)))
+            else:
+                pending.append((energy, pool.submit(self._footprint_job,
+                                                    energy, position)))
+        for energy, job in pending:
+            if pool != None:
+                job = job.result()
+            footprint_info, metrics = job
+            self.metrics.merge(metrics)
+            footprint = [row for row in footprint_info["footprint"] \
+                                     if row[2] != None and row[4] != None]
+            if len(footprint) > 0:
+                self._print_canvas("xy", "footprint", energy,
+                                   [row[2] for row in footprint], "x tune",
+                                   [row[4] for row in footprint], "y tune")
+            print >> fout, json.dumps(footprint_info)
+            fout.flush()
+
+    def _footprint_job(self, energy, position):
+        """
+        Track the amplitude grid at energy and find the tunes; returns a
+        tuple of (footprint_info, metrics). See find_tune_footprint.
+        """
+        metrics = TrackingMetrics(self.metrics.metrics_filename)
+        grid = [(x_amplitude, y_amplitude) \
+                             for y_amplitude in self.footprint_y_amplitudes \
+                             for x_amplitude in self.footprint_x_amplitudes]
+        hit_list = []
+        for x_amplitude, y_amplitude in grid:
+            hit = self._reference(energy)
+            hit["x"] = position+x_amplitude
+            hit["y"] += y_amplitude
+            hit_list.append(hit)
+        tmp_dir = self._temp_dir(energy)
+        tracking = self._setup_tracking(energy, self.nturns, tmp_dir, metrics)
+        tracking.track_many(hit_list)
+        try:
+            shutil.rmtree(tmp_dir)
+        except OSError:
+            pass
+        track_dict = dict([(track[0]["event_number"], track) \
+                                 for track in tracking.last if len(track) > 0])
+        events = [event for event in range(len(grid)) if event in track_dict]
+        track_list = [track_dict[event] for event in events]
+        method = self.tune_finder
+        if method == None:
+            method = "naff"
+        x_results = self._analyse_tracks(track_list, "x", "px", method)
+        y_results = self._analyse_tracks(track_list, "y", "py", method)
+        tunes = dict(zip(events, zip(x_results, y_results)))
+        footprint = []
+        for event, (x_amplitude, y_amplitude) in enumerate(grid):
+            x_result, y_result = tunes.get(event, ((None, None), (None, None)))
+            footprint.append([x_amplitude, y_amplitude, x_result[0],
+                              x_result[1], y_result[0], y_result[1]])
+        x_min = min(self.footprint_x_amplitudes)
+        y_min = min(self.footprint_y_amplitudes)
+        footprint_info = {
+            "energy":energy,
+            "nturns":self.nturns,
+            "stepsize":self.step_size,
+            "tune_finder":method,
+            "footprint":footprint,
+            "x_detuning":[[row[0], row[2], row[4]] for row in footprint \
+                                                           if row[1] == y_min],
+            "y_detuning":[[row[1], row[2], row[4]] for row in footprint \
+                                                           if row[0] == x_min],
+        }
+        return footprint_info, metrics
+
+    def _tune_job(self, energy, position, axes):
+        """
+        Find the tune at energy for each axis in axes, in its own temporary
+        directory and with its own TrackingMetrics, so that jobs may run
+        concurrently. If tune_tolerance is set, rerun with more turns until
+        the tune error is small enough. Returns a tuple of (tune_info,
+        metrics).
+        """
+        metrics = TrackingMetrics(self.metrics.metrics_filename)
+        nturns = self.nturns
+        while nturns != None:
             tune_info = {
                 "energy":energy,
-                "nturns":self.nturns,
+                "nturns":nturns,
                 "stepsize":self.step_size,
                 "poly_order":self.poly_order,
                 "smooth_order":self.smooth_order,
             }
-            for axis1, axis2, delta1, delta2 in [("x", "px", self.delta_x, 0.),
-                                                 ("y", "py", self.delta_y, 0.)]:
+            tmp_dir = self._temp_dir(energy)
+            if self.single_run:
+                self._find_tune_single_run(energy, position, tune_info,
+                                           tmp_dir, metrics)
+            else:
+                self._find_tune_per_axis(energy, position, tune_info, axes,
+                                         tmp_dir, metrics)
+            try:
+                shutil.rmtree(tmp_dir)
+            except OSError:
+                pass
+            nturns = self._extend_turns(tune_info)
+        return tune_info, metrics
+
+    def _write_tune(self, fout, energy, parameters, job_results):
+        """
+        Merge the tune_info from each job at energy, plot the signals, record
+        the result in the journal and write it to fout; if job_results is
+        None, the result is taken from the journal
+        """
+        if job_results == None:
+            print >> fout, json.dumps(self.journal.get(parameters))
+            fout.flush()
+            return
+        tune_info = {}
+        for job_info, metrics in job_results:
+            nturns = max(tune_info.get("nturns", 0.), job_info["nturns"])
+            tune_info.update(job_info)
+            tune_info["nturns"] = nturns
+            self.metrics.merge(metrics)
+        for axis1, axis2 in [("x", "px"), ("y", "py")]:
+            signal = tune_info.get(axis1+"_signal", [])
+            if len(signal) > 0:
+                self._print_canvas(axis1, "signal", energy,
+                                   [u[0] for u in signal], axis1+" [mm]",
+                                   [u[1] for u in signal], axis2+" [MeV/c]")
+        if self.journal != None:
+            self.journal.record(parameters, tune_info)
+        for key in sorted(tune_info.keys()):
+            if "signal" not in key:
+                print "   ", key, tune_info[key]
+        print >> fout, json.dumps(tune_info)
+        fout.flush()
+
+    def _find_tune_per_axis(self, energy, position, tune_info, axes, tmp_dir,
+                            metrics):
+        """
+        Find the tune with a separate tracking run for each axis in axes,
+        filling tune_info
+        """
+        for axis1, axis2, delta1, delta2 in [("x", "px", self.delta_x, 0.),
+                                             ("y", "py", self.delta_y, 0.)]:
+            if axis1 not in axes:
+                continue
+            hit = self._reference(energy)
+            hit["x"] = position
+            tracking = self._setup_tracking(energy, tune_info["nturns"],
+                                            tmp_dir, metrics)
+            if self.tune_finder != None:
+                hit[axis1] += delta1
+                hit[axis2] += delta2
+                tracking.track_one(hit)
+                self._print_tracks(tracking.last)
+                tune, tune_error, signal = \
+                       self._analyse_tracks(tracking.last, axis1, axis2)[0]
+                tune_info[axis1+"_tune"] = tune
+                tune_info[axis1+"_tune_error"] = tune_error
+                tune_info[axis1+"_signal"] = signal
+                continue
+            finder = DPhiTuneFinder()
+            finder.run_tracking(axis1, axis2, delta1, delta2, hit, tracking)
+            self._print_tracks(tracking.last)
+            tune = finder.get_tune(tune_info["nturns"]/10.)
+            tune_info[axis1+"_tune"] = tune
+            tune_info[axis1+"_tune_error"] = finder.tune_error
+            tune_info[axis1+"_signal"] = zip(finder.u, finder.up)
+
+    def _find_tune_single_run(self, energy, position, tune_info, tmp_dir,
+                              metrics):
+        """
+        Find the tune for both axes, and each amplitude in amplitude_list,
+        from a single multi-particle tracking run, filling tune_info. The
+        first amplitude gives the usual "x_tune", "y_tune" etc; if there is
+        more than one amplitude, "x_detuning" and "y_detuning" hold a list of
+        [delta, tune, tune_error] for every amplitude.
+        """
+        axis_list = [("x", "px", self.delta_x), ("y", "py", self.delta_y)]
+        hit_list, job_list = [], []
+        for amplitude in self.amplitude_list:
+            for axis1, axis2, delta in axis_list:
                 hit = self._reference(energy)
                 hit["x"] = position
-                self._temp_dir()
-                common.substitute(
-                    self.lattice_src, 
-                    self.tmp_dir+self.lattice, {
-                        "__energy__":energy,
-                        "__nturns__":self.nturns,
-                        "__beamfile__":self.tmp_dir+self.beam_file,
-                        "__stepsize__":self.step_size,
-                        "__poly_order__":self.poly_order,
-                        "__smooth_order__":self.smooth_order,
-                })
-                tracking = OpalTracking(self.tmp_dir+self.lattice,
-                                        self.tmp_dir+self.beam_file,
-                                        self._reference(energy),
-                                        self.output_filename,
-                                        self.opal,
-                                        self.tmp_dir+self.log_file)
+                hit[axis1] += delta*amplitude
+                hit_list.append(hit)
+                job_list.append((axis1, axis2, delta*amplitude))
+        tracking = self._setup_tracking(energy, tune_info["nturns"], tmp_dir,
+                                        metrics)
+        tracking.track_many(hit_list)
+        self._print_tracks(tracking.last)
+        # map event number to track, as lost particles may have no hits
+        track_dict = dict([(track[0]["event_number"], track) \
+                                 for track in tracking.last if len(track) > 0])
+        analysis = {} # maps event to (tune, tune_error, signal)
+        if self.tune_finder != None:
+            for axis1, axis2, delta in axis_list:
+                events = [event for event, job in enumerate(job_list) \
+                                if job[0] == axis1 and event in track_dict]
+                results = self._analyse_tracks([track_dict[event] \
+                                          for event in events], axis1, axis2)
+                analysis.update(zip(events, results))
+        for event, (axis1, axis2, delta) in enumerate(job_list):
+            tune, tune_error, signal = None, None, []
+            if event in analysis:
+                tune, tune_error, signal = analysis[event]
+            elif event in track_dict:
+                seed = self._reference(energy)
+                seed["x"] = position
                 finder = DPhiTuneFinder()
-                finder.run_tracking(axis1, axis2, delta1, delta2, hit, tracking)
-                for track_index, track in enumerate(tracking.last):
-                    print 'Track', track_index, 'of', len(tracking.last), \
-                          'with', len(track), 'hits'
-                    for hit in track:
-                        print '    ', hit['t'], 'polar:', math.atan2(hit['y'], \
-                              hit['x']), (hit['y']**2+hit['x']**2)**0.5, \
-                              'cart:', hit['x'], hit['y'], hit['z']
-                tune = finder.get_tune(self.nturns/10.)
+                finder.run_tracking(axis1, axis2, delta, 0., seed,
+                                    StoredTracking([track_dict[event]]))
+                tune = finder.get_tune(tune_info["nturns"]/10.)
+                tune_error = finder.tune_error
+                signal = zip(finder.u, finder.up)
+            if axis1+"_tune" not in tune_info:
                 tune_info[axis1+"_tune"] = tune
-                tune_info[axis1+"_tune_error"] = finder.tune_error
-                tune_info[axis1+"_signal"] = zip(finder.u, finder.up)
-            for key in sorted(tune_info.keys()):
-                if "signal" not in key:
-                    print "   ", key, tune_info[key]
-            print >> fout, json.dumps(tune_info)
-            fout.flush()
+                tune_info[axis1+"_tune_error"] = tune_error
+                tune_info[axis1+"_signal"] = signal
+            if len(self.amplitude_list) > 1:
+                detuning = tune_info.setdefault(axis1+"_detuning", [])
+                detuning.append([delta, tune, tune_error])
+
+    def _analyse_tracks(self, track_list, axis1, axis2, method = None):
+        """
+        Find the tune of every track in track_list with tune_analysis, using
+        method (or tune_finder if method is None); tracks with the same
+        number of hits are analysed together. Returns a list of (tune,
+        tune_error, signal), one for each track; tune and tune_error are
+        None if a track has too few hits or no motion.
+        """
+        if method == None:
+            method = self.tune_finder
+        results = [(None, None, [])]*len(track_list)
+        by_length = {}
+        for i, track in enumerate(track_list):
+            by_length.setdefault(len(track), []).append(i)
+        for length, index_list in by_length.iteritems():
+            u = [[hit[axis1] for hit in track_list[i]] for i in index_list]
+            up = [[hit[axis2] for hit in track_list[i]] for i in index_list]
+            if length < 4:
+                for i, u_i, up_i in zip(index_list, u, up):
+                    results[i] = (None, None, zip(u_i, up_i))
+                continue
+            tunes, errors = tune_analysis.find_tunes(u, up, method)
+            for j, i in enumerate(index_list):
+                tune, error = None, None
+                if numpy.isfinite(tunes[j]):
+                    tune, error = float(tunes[j]), float(errors[j])
+                results[i] = (tune, error, zip(u[j], up[j]))
+        return results
 
-    def _temp_dir(self):
-        """Make a temporary directory for tune calculation"""
-        self.tmp_dir = "tmp/tune/"+str(self.unique_id)+"/"
+    def _journal_parameters(self, energy):
+        """Parameters that identify the tune calculation at energy"""
+        return {
+            "energy":float(energy),
+            "closed_orbit":self.closed_orbits_cached[energy],
+            "nturns":self.nturns,
+            "stepsize":self.step_size,
+            "poly_order":self.poly_order,
+            "smooth_order":self.smooth_order,
+            "delta_x":self.delta_x,
+            "delta_y":self.delta_y,
+            "amplitude_list":self.amplitude_list,
+            "tune_tolerance":self.tune_tolerance,
+            "tune_finder":self.tune_finder,
+        }
+
+    def _extend_turns(self, tune_info):
+        """
+        If tune_tolerance is set and any tune error in tune_info is above it,
+        return twice the number of turns in tune_info; tunes of lost particles
+        (with no error) are ignored. Returns None if no rerun is needed or the
+        number of turns would exceed max_nturns.
+        """
+        if self.tune_tolerance == None:
+            return None
+        errors = [tune_info[key] for key in tune_info \
+                      if key.endswith("_tune_error") and tune_info[key] != None]
+        if len(errors) == 0 or max(errors) <= self.tune_tolerance:
+            return None
+        nturns = tune_info["nturns"]
+        # keep the fractional turn so that the last probe hit is recorded
+        next_nturns = round(2*int(nturns)+nturns-int(nturns), 6)
+        if next_nturns > self.max_nturns:
+            print "Tune error", max(errors), "but reached", nturns, "turns"
+            return None
+        print "Tune error", max(errors), "; rerunning with", next_nturns, "turns"
+        return next_nturns
+
+    def _setup_tracking(self, energy, nturns, tmp_dir, metrics):
+        """
+        Make the lattice in tmp_dir; return an OpalTracking that runs OPAL in
+        tmp_dir, or that reads probe_file_name if just plotting
+        """
+        tracking = EnergyScan._setup_tracking(self, energy, nturns, tmp_dir,
+                                              metrics)
+        tracking.do_tracking = not self.just_plot
         if self.just_plot:
-            return
-        try:
-            shutil.rmtree(self.tmp_dir)
-        except OSError:
-            pass
-        os.makedirs(self.tmp_dir)
-
-    def _load_closed_orbits(self, filename):
-        """Load closed orbits from a json file"""
-        fin = open(filename)
-        closed_orbits = [json.loads(line) for line in fin.readlines()]
-        closed_orbits_energy = [orbit[0] for orbit in closed_orbits]
-        closed_orbits_x = [orbit[1:][0][0] for orbit in closed_orbits]
-        closed_orbits_dict = dict(zip(closed_orbits_energy, closed_orbits_x))
-        self.closed_orbits_cached = closed_orbits_dict
-
-    def _reference(self, energy):
-        """Generate a reference particle"""
-        hit_dict = {}
-        hit_dict["pid"] = 2212
-        hit_dict["mass"] = common.pdg_pid_to_mass[2212]
-        hit_dict["charge"] = 1
-        hit_dict["x"] = 4600.
-        hit_dict["kinetic_energy"] = energy
-        return Hit.new_from_dict(hit_dict, "pz")
-
-    def _print_canvas(self, canvas, axis, name, energy):
-        """Print a canvas"""
+            # the same probe file is read for every energy and axis; new
+            # runs are read once and their tmp_dir removed
+            tracking.sidecar = True
+            tracking.run_dir = None
+        return tracking
+
+    def _print_tracks(self, track_list):
+        """Print the hits in each track"""
+        for track_index, track in enumerate(track_list):
+            print 'Track', track_index, 'of', len(track_list), \
+                  'with', len(track), 'hits'
+            for hit in track:
+                print '    ', hit['t'], 'polar:', math.atan2(hit['y'], \
+                      hit['x']), (hit['y']**2+hit['x']**2)**0.5, \
+                      'cart:', hit['x'], hit['y'], hit['z']
+
+    def _print_canvas(self, axis, name, energy, x_list, x_label, y_list,
+                      y_label):
+        """Send a scatter plot of y_list against x_list to plot_queue"""
+        title = axis+" "+name+" KE="+str(energy)
         name = "plots/"+axis+"_"+name+"_energy="+str(energy)+self.string_id
-        for format in ["png", "root"]:
-            canvas.Print(name+"."+format)
+        self.plot_queue.scatter(name, x_list, x_label, y_list, y_label, title,
+                                formats=("png", "root"))
 
 def main():
+    """
+    Find tunes; the first command line argument, if given, is the unique_id
+    (e.g. to resume an earlier run from its journal)
+    """
+    unique_id = None
+    if len(sys.argv) > 1:
+        unique_id = sys.argv[1]
     tune = Tune(None,
                 "lattices/KurriMainRingTuneComparison/closed_orbits.ref",
                 10.99,
-                15.01)
+                15.01,
+                unique_id)
+    tune.journal = ResultsJournal(tune.output+".journal")
     tune.find_tune_dphi()
 
 if __name__ == "__main__":
     main()
     print "Finished"
-    raw_input()
+    wait_for_user()
 
 
 
@@ -0,0 +1,198 @@
+"""
+Closed orbit table shared by the driver scripts: radius, mean time of flight
+and revolution frequency against kinetic energy, read from the closed orbit
+file written by find_closed_orbits.py and interpolated with monotone cubic
+(PCHIP) interpolants. Prepared tables are cached on disk, keyed by a hash of
+the closed orbit file, so each file is only parsed once.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy
+
+class MonotoneInterpolator(object):
+    def __init__(self, x_array, y_array):
+        """
+        Piecewise cubic Hermite interpolant with Fritsch-Carlson slopes
+        (PCHIP), which does not overshoot the data and so preserves
+        monotonicity; beyond the first and last points the interpolant is
+        extrapolated linearly using the end slopes.
+
+        - x_array: strictly increasing array of knots
+        - y_array: array of values at the knots
+        """
+        self.x = numpy.array(x_array, dtype=numpy.float64)
+        self.y = numpy.array(y_array, dtype=numpy.float64)
+        self.slopes = self._slopes()
+
+    def __call__(self, x):
+        """Return the interpolated value at x (a float or an array)"""
+        x = numpy.asarray(x, dtype=numpy.float64)
+        if len(self.x) == 1:
+            return self.y[0]+numpy.zeros(x.shape)
+        index = numpy.clip(numpy.searchsorted(self.x, x)-1, 0, len(self.x)-2)
+        x0, x1 = self.x[index], self.x[index+1]
+        y0, y1 = self.y[index], self.y[index+1]
+        d0, d1 = self.slopes[index], self.slopes[index+1]
+        h = x1-x0
+        t = (x-x0)/h
+        value = (2*t**3-3*t**2+1)*y0+(t**3-2*t**2+t)*h*d0+\
+                (-2*t**3+3*t**2)*y1+(t**3-t**2)*h*d1
+        below, above = x < self.x[0], x > self.x[-1]
+        value = numpy.where(below, self.y[0]+self.slopes[0]*(x-self.x[0]),
+                                                                        value)
+        value = numpy.where(above, self.y[-1]+self.slopes[-1]*(x-self.x[-1]),
+                                                                        value)
+        return value
+
+    def _slopes(self):
+        """Fritsch-Carlson slopes at each knot"""
+        n_points = len(self.x)
+        if n_points == 1:
+            return numpy.zeros(1)
+        h = numpy.diff(self.x)
+        delta = numpy.diff(self.y)/h
+        if n_points == 2:
+            return numpy.array([delta[0], delta[0]])
+        slopes = numpy.zeros(n_points)
+        # weighted harmonic mean where the secants have the same sign
+        w1 = 2*h[1:]+h[:-1]
+        w2 = h[1:]+2*h[:-1]
+        same_sign = delta[:-1]*delta[1:] > 0.
+        safe_0 = numpy.where(same_sign, delta[:-1], 1.)
+        safe_1 = numpy.where(same_sign, delta[1:], 1.)
+        slopes[1:-1] = numpy.where(same_sign,
+                                   (w1+w2)/(w1/safe_0+w2/safe_1), 0.)
+        slopes[0] = self._end_slope(h[0], h[1], delta[0], delta[1])
+        slopes[-1] = self._end_slope(h[-1], h[-2], delta[-1], delta[-2])
+        return slopes
+
+    def _end_slope(self, h0, h1, delta0, delta1):
+        """Three point end slope, limited to keep the interpolant monotone"""
+        slope = ((2*h0+h1)*delta0-h0*delta1)/(h0+h1)
+        if numpy.sign(slope) != numpy.sign(delta0):
+            return 0.
+        if numpy.sign(delta0) != numpy.sign(delta1) and \
+           abs(slope) > 3*abs(delta0):
+            return 3*delta0
+        return slope
+
+class LatticeTable(object):
+    def __init__(self, energy_list, radius_list, tof_list):
+        """
+        Table of closed orbit radius and mean time of flight against kinetic
+        energy; usually made by load_lattice_table.
+
+        - energy_list: list of kinetic energies [MeV], in increasing order;
+                       kept as given (e.g. ints) for use as dict keys
+        - radius_list: closed orbit radius at each energy [mm]
+        - tof_list: mean time of flight for one turn at each energy [ns]
+        """
+        self.energy_list = list(energy_list)
+        self.energy = numpy.array(energy_list, dtype=numpy.float64)
+        self.radius_array = numpy.array(radius_list, dtype=numpy.float64)
+        self.tof_array = numpy.array(tof_list, dtype=numpy.float64)
+        self.frequency_array = 1./self.tof_array
+        self._radius = MonotoneInterpolator(self.energy, self.radius_array)
+        self._tof = MonotoneInterpolator(self.energy, self.tof_array)
+        self._frequency = MonotoneInterpolator(self.energy,
+                                               self.frequency_array)
+
+    def radius(self, energy):
+        """Closed orbit radius [mm] at energy (a float or an array) [MeV]"""
+        return self._radius(energy)
+
+    def tof(self, energy):
+        """Mean time of flight [ns] at energy (a float or an array) [MeV]"""
+        return self._tof(energy)
+
+    def frequency(self, energy):
+        """
+        Revolution frequency [GHz] at energy (a float or an array) [MeV];
+        interpolated in frequency rather than taken as 1/tof(energy)
+        """
+        return self._frequency(energy)
+
+    def radius_dict(self):
+        """Return a dict mapping each energy in the table to radius"""
+        return dict(zip(self.energy_list, self.radius_array.tolist()))
+
+    def tof_dict(self):
+        """Return a dict mapping each energy in the table to time of flight"""
+        return dict(zip(self.energy_list, self.tof_array.tolist()))
+
+    @classmethod
+    def from_closed_orbits(cls, closed_orbits):
+        """
+        Make a LatticeTable from a list of closed orbits, each a list
+        [energy, [x, t], [x, t], ...] as written by find_closed_orbits.py.
+        The radius is the first x. Hits that repeat the time of the previous
+        hit (e.g. the duplicate hit at t = 0) are dropped before taking the
+        mean time between hits as the time of flight. Orbits with fewer
+        than two distinct times are ignored; if an energy appears more than
+        once, the last orbit is used.
+        """
+        orbit_dict = {}
+        for orbit in closed_orbits:
+            times = [orbit[1][1]]
+            for x, t in orbit[2:]:
+                if abs(t-times[-1]) > 1e-9:
+                    times.append(t)
+            if len(times) < 2:
+                continue
+            tof = (times[-1]-times[0])/(len(times)-1)
+            orbit_dict[orbit[0]] = (orbit[1][0], tof)
+        energy_list = sorted(orbit_dict.keys())
+        return cls(energy_list,
+                   [orbit_dict[energy][0] for energy in energy_list],
+                   [orbit_dict[energy][1] for energy in energy_list])
+
+_tables = {} # maps file hash to LatticeTable
+
+def load_lattice_table(file_name, cache_dir = "tmp/lattice_table/"):
+    """
+    Return the LatticeTable for a closed orbit file. Tables are kept in
+    memory and in cache_dir, keyed by the sha1 of the file contents, so the
+    file is only parsed again if it changes.
+    - file_name: closed orbit file, one json list per line
+    - cache_dir: directory for cached tables, or None to disable the disk
+      cache
+    """
+    text = open(file_name).read()
+    key = hashlib.sha1(text).hexdigest()
+    if key in _tables:
+        return _tables[key]
+    cache_name = None
+    table = None
+    if cache_dir != None:
+        cache_name = os.path.join(cache_dir, key+".npz")
+        try:
+            cached = numpy.load(cache_name)
+            table = LatticeTable(json.loads(str(cached["energy_list"])),
+                                 cached["radius"], cached["tof"])
+        except (IOError, OSError, KeyError, ValueError):
+            table = None
+    if table == None:
+        closed_orbits = [json.loads(line) for line in text.split("\n") \
+                                                          if line.strip() != ""]
+        table = LatticeTable.from_closed_orbits(closed_orbits)
+        if cache_name != None:
+            _save_table(table, cache_dir, cache_name)
+    _tables[key] = table
+    return table
+
+def _save_table(table, cache_dir, cache_name):
+    """Write table to cache_name, atomically so parallel jobs can share it"""
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    file_handle, temp_name = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    fout = os.fdopen(file_handle, "wb")
+    numpy.savez(fout, energy_list=numpy.array(json.dumps(table.energy_list)),
+                radius=table.radius_array, tof=table.tof_array)
+    fout.close()
+    os.rename(temp_name, cache_name)
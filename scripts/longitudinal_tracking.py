@@ -0,0 +1,280 @@
+"""
+Fast longitudinal model of the acceleration cycle, for checking RF programs
+before running OPAL. Macroparticles are described by their kinetic energy and
+the time at which they cross the RF cavity; each turn they receive an energy
+kick from the cavity and then slip in time by the time of flight at their
+new energy, taken from the closed orbit table (see lattice_table).
+
+The cavity follows the POLYNOMIAL_TIME_DEPENDENCE programs of an OPAL
+VARIABLE_RF_CAVITY, i.e. the energy gain on crossing at time t is
+    dE = A(t) L sin(2 pi f(t) t + phi(t))
+where f, A and phi are polynomials in t [ns] and L is the cavity length.
+"""
+
+import math
+import re
+import sys
+import time
+
+import numpy
+
+from lattice_table import load_lattice_table
+
+class LongitudinalTracking(object):
+    def __init__(self, lattice_table):
+        """
+        Initialise the tracking.
+
+        - lattice_table: LatticeTable giving the time of flight against energy
+
+        Set the RF program in frequency_coefficients, amplitude_coefficients
+        and phase_coefficients (P0, P1, ... as in the OPAL lattice), or read
+        them from a lattice with load_rf_program. Particles with energy
+        outside energy_min to energy_max (by default, the range of the
+        closed orbit table) are counted as lost.
+        """
+        self.lattice_table = lattice_table
+        self.frequency_coefficients = [0.] # [GHz], [GHz/ns], ...
+        self.amplitude_coefficients = [0.] # [MV/m], [MV/m/ns], ...
+        self.phase_coefficients = [0.] # [rad], [rad/ns], ...
+        self.cavity_length = 10. # [mm]
+        self.energy_min = float(lattice_table.energy[0]) # [MeV]
+        self.energy_max = float(lattice_table.energy[-1]) # [MeV]
+        # time of flight is tabulated on a regular grid with this spacing, so
+        # that each turn needs only a lookup and a linear interpolation
+        self.energy_step = 1e-3 # [MeV]
+        self.max_particles = 2000000 # particles tracked at once by scan
+        self._tof_grid = None # ((step, min, max), tof array, slope array)
+
+    def load_rf_program(self, lattice_file_name):
+        """
+        Read the RF programs from the POLYNOMIAL_TIME_DEPENDENCE elements
+        used by the VARIABLE_RF_CAVITY in an OPAL lattice. Coefficients may
+        use variables assigned earlier in the lattice (e.g. P0=phi).
+        """
+        text = re.sub("//[^\n]*", "", open(lattice_file_name).read())
+        variables = {"PI":math.pi, "TWOPI":2.*math.pi, "sqrt":math.sqrt,
+                     "sin":math.sin, "cos":math.cos}
+        polynomials = {}
+        for statement in text.split(";"):
+            statement = statement.strip()
+            match = re.match("(\w+)\s*:\s*POLYNOMIAL_TIME_DEPENDENCE\s*,(.*)",
+                             statement, re.S | re.I)
+            if match != None:
+                coefficients = {}
+                for index, expression in re.findall("P(\d+)\s*=\s*([^,]+)",
+                                                    match.group(2), re.I):
+                    coefficients[int(index)] = \
+                              self._evaluate(expression, variables)
+                polynomials[match.group(1).upper()] = \
+                   [coefficients.get(i, 0.) for i in range(max(coefficients)+1)]
+                continue
+            match = re.match("(\w+)\s*:\s*VARIABLE_RF_CAVITY\s*,(.*)",
+                             statement, re.S | re.I)
+            if match != None:
+                models = dict(re.findall("(\w+)_MODEL\s*=\s*\"(\w+)\"",
+                                         match.group(2), re.I))
+                models = dict([(key.upper(), value.upper()) \
+                                          for key, value in models.iteritems()])
+                self.frequency_coefficients = polynomials[models["FREQUENCY"]]
+                self.amplitude_coefficients = polynomials[models["AMPLITUDE"]]
+                self.phase_coefficients = polynomials[models["PHASE"]]
+                return
+            match = re.match("(\w+)\s*=([^=].*)", statement, re.S)
+            if match != None:
+                try:
+                    variables[match.group(1)] = \
+                                      self._evaluate(match.group(2), variables)
+                except Exception:
+                    pass # e.g. uses OPAL constants; not needed for RF
+        raise ValueError("No VARIABLE_RF_CAVITY found in "+lattice_file_name)
+
+    def gaussian_bunch(self, n_particles, energy, energy_rms, time, time_rms,
+                       seed = None):
+        """
+        Return a tuple of arrays (energy, time) for a bunch of n_particles
+        with gaussian distributions in energy [MeV] and cavity crossing time
+        [ns]
+        """
+        random = numpy.random.RandomState(seed)
+        return random.normal(energy, energy_rms, n_particles), \
+               random.normal(time, time_rms, n_particles)
+
+    def track(self, energy, time, n_turns, settings = None):
+        """
+        Track macroparticles through n_turns turns.
+        - energy, time: arrays of kinetic energy [MeV] and time of the next
+          cavity crossing [ns]. If settings is given, arrays have shape
+          (len(settings), n_particles), with one row for each setting;
+          otherwise they are one dimensional.
+        - n_turns: number of turns
+        - settings: None to use the RF program in this object, or a list of
+          dicts, each overriding some of "frequency_coefficients",
+          "amplitude_coefficients" and "phase_coefficients"
+        Returns a dict of arrays with the same shape as energy: "energy",
+        "time" and "lost" (True if the energy left energy_min to energy_max
+        on any turn). Lost particles are still tracked, with time of flight
+        at the nearest end of the table.
+        """
+        one_dimensional = numpy.ndim(energy) == 1
+        energy = numpy.array(energy, dtype=numpy.float64, ndmin=2)
+        time = numpy.array(time, dtype=numpy.float64, ndmin=2)
+        if settings == None:
+            settings = [{}]
+        frequency = self._coefficients(settings, "frequency_coefficients")
+        amplitude = self._coefficients(settings, "amplitude_coefficients")
+        phase = self._coefficients(settings, "phase_coefficients")
+        # MV/m * mm * charge 1 => MeV
+        amplitude = amplitude*self.cavity_length*1e-3
+        lost = numpy.zeros(energy.shape, dtype=bool)
+        rf_phase = numpy.empty(energy.shape)
+        kick = numpy.empty(energy.shape)
+        index = numpy.empty(energy.shape, dtype=numpy.intp)
+        for turn in range(n_turns):
+            self._polynomial(frequency, time, rf_phase)
+            rf_phase *= 2.*math.pi
+            rf_phase *= time
+            rf_phase += self._polynomial(phase, time, kick)
+            numpy.sin(rf_phase, rf_phase)
+            rf_phase *= self._polynomial(amplitude, time, kick)
+            energy += rf_phase
+            lost |= energy < self.energy_min
+            lost |= energy > self.energy_max
+            time += self._tof(energy, kick, index)
+        if one_dimensional:
+            energy, time, lost = energy[0], time[0], lost[0]
+        return {"energy":energy, "time":time, "lost":lost}
+
+    def scan(self, settings, energy, time, n_turns):
+        """
+        Track the same bunch with each RF setting; settings are tracked
+        together, in blocks of at most max_particles macroparticles
+        - settings: list of dicts, as for track
+        - energy, time: one dimensional arrays describing the bunch
+        - n_turns: number of turns
+        Returns a list with a dict for each setting holding "setting",
+        "survival" (fraction of particles not lost) and the "mean_energy",
+        "rms_energy" [MeV], "mean_time" and "rms_time" [ns] of the surviving
+        particles (None if no particles survive)
+        """
+        energy = numpy.array(energy, dtype=numpy.float64)
+        time = numpy.array(time, dtype=numpy.float64)
+        block = max(self.max_particles/len(energy), 1)
+        summaries = []
+        for start in range(0, len(settings), block):
+            block_settings = settings[start:start+block]
+            shape = (len(block_settings), len(energy))
+            result = self.track(numpy.broadcast_to(energy, shape),
+                                numpy.broadcast_to(time, shape),
+                                n_turns, block_settings)
+            for i, setting in enumerate(block_settings):
+                good = ~result["lost"][i]
+                summary = {"setting":setting,
+                           "survival":numpy.mean(good),
+                           "mean_energy":None, "rms_energy":None,
+                           "mean_time":None, "rms_time":None}
+                if numpy.any(good):
+                    for key in "energy", "time":
+                        values = result[key][i][good]
+                        summary["mean_"+key] = numpy.mean(values)
+                        summary["rms_"+key] = numpy.std(values)
+                summaries.append(summary)
+        return summaries
+
+    def _coefficients(self, settings, name):
+        """
+        Array of shape (len(settings), n_coefficients) holding the coefficients
+        called name for each setting, padded with zeros
+        """
+        coefficient_list = [setting.get(name, getattr(self, name)) \
+                                                        for setting in settings]
+        n_coefficients = max([len(item) for item in coefficient_list])
+        coefficients = numpy.zeros((len(settings), n_coefficients))
+        for i, item in enumerate(coefficient_list):
+            coefficients[i, :len(item)] = item
+        return coefficients
+
+    def _polynomial(self, coefficients, time, out):
+        """
+        Evaluate P0 + P1 t + P2 t^2 + ... into out, for each row of time
+        using the coefficients in the same row of coefficients
+        """
+        out[:] = coefficients[:, -1, numpy.newaxis]
+        for i in range(coefficients.shape[1]-2, -1, -1):
+            out *= time
+            out += coefficients[:, i, numpy.newaxis]
+        return out
+
+    def _tof(self, energy, out, index):
+        """
+        Time of flight at energy, by linear interpolation on a regular grid
+        (held at the end values outside the grid); the result is written to
+        out, and index is used as workspace
+        """
+        tof, slope = self._tof_table()
+        numpy.subtract(energy, self.energy_min, out)
+        out *= 1./self.energy_step
+        numpy.clip(out, 0., len(tof)-1, out)
+        index[...] = out
+        numpy.minimum(index, len(tof)-2, index)
+        out -= index
+        out *= slope[index]
+        out += tof[index]
+        return out
+
+    def _tof_table(self):
+        """
+        Time of flight from lattice_table on a regular grid in energy, and
+        the change in time of flight from each grid point to the next
+        """
+        key = (self.energy_step, self.energy_min, self.energy_max)
+        if self._tof_grid == None or self._tof_grid[0] != key:
+            n_points = int(math.ceil((self.energy_max-self.energy_min)/\
+                                     self.energy_step))+1
+            grid_energy = self.energy_min+\
+                                    numpy.arange(n_points)*self.energy_step
+            tof = self.lattice_table.tof(grid_energy)
+            self._tof_grid = (key, tof, numpy.diff(tof))
+        return self._tof_grid[1:]
+
+    def _evaluate(self, expression, variables):
+        """Evaluate an OPAL expression using variables"""
+        expression = expression.strip().replace("^", "**")
+        return float(eval(expression, {"__builtins__":{}}, variables))
+
+def main():
+    """Track the RF program in the acceleration lattice, then scan it"""
+    table = load_lattice_table(
+                      "lattices/KurriMainRingTuneComparison/closed_orbits.ref")
+    tracking = LongitudinalTracking(table)
+    tracking.energy_min = 10. # table starts at injection; allow some spread
+    tracking.load_rf_program("lattices/KurriMainRingWithAcceleration/"+\
+                             "KurriMainRingWithAcceleration.in")
+    print "Frequency program", tracking.frequency_coefficients
+    print "Amplitude program", tracking.amplitude_coefficients
+    print "Phase program", tracking.phase_coefficients
+    n_turns = 1000
+    energy, crossing_time = tracking.gaussian_bunch(1000000, 11., 1e-2, 0., 10.)
+    start = time.time()
+    result = tracking.track(energy, crossing_time, n_turns)
+    good = ~result["lost"]
+    print "Tracked", len(energy), "particles for", n_turns, "turns in", \
+          round(time.time()-start, 1), "s"
+    print "Survival", numpy.mean(good), "mean energy", \
+          numpy.mean(result["energy"][good]), "MeV"
+    settings = []
+    for amplitude in [0.2, 0.4, 0.8]:
+        for phase in [0., math.pi/6, math.pi/2+math.pi/6]:
+            settings.append({"amplitude_coefficients":[amplitude],
+                             "phase_coefficients":[phase]})
+    energy, crossing_time = tracking.gaussian_bunch(100000, 11., 1e-2, 0., 10.)
+    start = time.time()
+    for summary in tracking.scan(settings, energy, crossing_time, n_turns):
+        print summary["setting"], "survival", summary["survival"], \
+              "mean energy", summary["mean_energy"]
+    print "Scanned", len(settings), "settings in", \
+          round(time.time()-start, 1), "s"
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -2,28 +2,90 @@
 Massage field map into the correct format
 """
 
-def main():
-    """Main function"""
-    field_map_in = open("tosca_map_f810_d1020.table")
-    for i in range(8):
-        line = field_map_in.readline()
-        print line,
+import numpy
+
+def read_blocks(field_map_in, block_column, keep_lines = False,
+                chunk_size = 2**24):
+    """
+    Read the table of numbers in field_map_in, from the current position to
+    the end of the file, about chunk_size bytes at a time, so that memory use
+    is bounded by the chunk size and the largest block
+    - field_map_in: file object, e.g. after reading the header lines
+    - block_column: index of the column that labels each block
+    - keep_lines: if True, also keep the text of each line
+    - chunk_size: number of bytes to read at a time
+    Yields a tuple of (values, lines) for each block of consecutive lines
+    with the same value in block_column; values is an array with a row of
+    floats for each line and lines is a list of the lines, or None if
+    keep_lines is False. Blank lines are ignored.
+    """
+    n_columns = None
+    pending_values, pending_lines = None, None
+    remainder = ""
+    while True:
+        text = field_map_in.read(chunk_size)
+        at_end = text == ""
+        text = remainder+text
+        if at_end:
+            remainder = ""
+        else: # keep the partial last line for the next chunk
+            cut = text.rfind("\n")+1
+            text, remainder = text[:cut], text[cut:]
+        if text.strip() != "":
+            if n_columns == None:
+                n_columns = len(text.strip().split("\n", 1)[0].split())
+            values = numpy.fromstring(text, sep=" ")
+            if len(values) % n_columns != 0:
+                raise ValueError("Field map lines should all have "+\
+                                 str(n_columns)+" columns")
+            values = values.reshape(-1, n_columns)
+            lines = None
+            if keep_lines:
+                lines = [line for line in text.splitlines(True) \
+                                                              if line.strip()]
+            if pending_values is not None:
+                values = numpy.concatenate((pending_values, values))
+                lines = _join(pending_lines, lines)
+            labels = values[:, block_column]
+            starts = [0]+(numpy.nonzero(labels[1:] != labels[:-1])[0]+1).tolist()
+            for start, end in zip(starts[:-1], starts[1:]):
+                yield values[start:end], _slice(lines, start, end)
+            pending_values = values[starts[-1]:]
+            pending_lines = _slice(lines, starts[-1], len(values))
+        if at_end:
+            break
+    if pending_values is not None:
+        yield pending_values, pending_lines
+
+def _join(lines_0, lines_1):
+    """Join two lists of lines, either of which may be None"""
+    if lines_0 == None:
+        return lines_1
+    return lines_0+lines_1
 
-    current_word = ''
-    block = []
-    for i, line in enumerate(field_map_in.readlines()):
-        words = line.split()
-        if words[1] == current_word:
-            block.append(line)
-        else:
-            current_word = words[1]
-            for line_out in reversed(block):
-                print line_out,
-            block = [line]
+def _slice(lines, start, end):
+    """Slice a list of lines, which may be None"""
+    if lines == None:
+        return None
+    return lines[start:end]
 
-    for line_out in reversed(block):
-        print line_out,
+def massage_field_map(file_name_in, file_name_out, chunk_size = 2**24):
+    """
+    Copy the 8 line header, then reverse the order of the lines within each
+    block of lines having the same second column
+    """
+    field_map_in = open(file_name_in)
+    field_map_out = open(file_name_out, "w")
+    for i in range(8):
+        field_map_out.write(field_map_in.readline())
+    for values, lines in read_blocks(field_map_in, 1, True, chunk_size):
+        field_map_out.write("".join(reversed(lines)))
+    field_map_out.close()
+
+def main():
+    """Main function"""
+    massage_field_map("tosca_map_f810_d1020.table",
+                      "tosca_map_f810_d1020_massaged.table")
 
 if __name__ == "__main__":
     main()
-
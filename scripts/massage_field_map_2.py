@@ -4,56 +4,59 @@ Massage field map into the correct format
 
 import math
 
+import numpy
+
+from massage_field_map import read_blocks
+
 def cylindrical_to_cartesian(r, phi, axis):
-    x = r*math.cos(phi)
-    z = r*math.sin(phi)
+    """Convert r, phi, axis (floats or arrays) to x, y, z"""
+    x = r*numpy.cos(phi)
+    z = r*numpy.sin(phi)
     y = axis
     return (x, y, z)
 
-def print_block(block):
-    for line_out in reversed(block):
-        words = line_out.split()
-        r = float(words[0])
-        phi = float(words[1])
-        axis = float(words[2])
-        phi = abs(phi-math.pi/2.)
-        x, y, z = cylindrical_to_cartesian(r, phi, axis)
-        #if abs(r-390.) < 0.1 and abs(axis-0.1) < 0.01:
-        print x, y, z, words[3], words[4], float(words[5])
+def massage_block(block):
+    """
+    Convert one vertical block of the map, an array with rows of r, phi,
+    axis and three field components; the block is mirrored about
+    phi = pi/2 (skipping the first row, which lies on the symmetry
+    point) and converted to cartesian coordinates. Returns an array with
+    rows of x, y, z and field.
+    """
     # QUERY - SHOULD BZ BE NEGATIVE AFTER SYMMETRY POINT
-    for line_out in block[1:]:
-        words = line_out.split()
-        r = float(words[0])
-        phi = float(words[1])
-        axis = float(words[2])       
-        phi = -abs(phi-math.pi/2.)
-        x, y, z = cylindrical_to_cartesian(r, phi, axis)
-        #if abs(r-390.) < 0.1 and abs(axis-0.1) < 0.01:
-        print x, y, z, words[3], words[4], -float(words[5])
+    mirror = block[1:].copy()
+    mirror[:, 5] *= -1.
+    half_list = [(block[::-1], 1.), (mirror, -1.)]
+    block_out = numpy.empty((2*len(block)-1, 6))
+    row = 0
+    for half, sign in half_list:
+        phi = sign*numpy.abs(half[:, 1]-math.pi/2.)
+        x, y, z = cylindrical_to_cartesian(half[:, 0], phi, half[:, 2])
+        rows = slice(row, row+len(half))
+        block_out[rows, 0], block_out[rows, 1], block_out[rows, 2] = x, y, z
+        block_out[rows, 3:6] = half[:, 3:6]
+        row += len(half)
+    return block_out
+
+def massage_field_map(file_name_in, file_name_out, chunk_size = 2**24):
+    """
+    Copy the 8 line header, then write each vertical block (lines with the
+    same axis position) converted by massage_block
+    """
+    field_map_in = open(file_name_in)
+    field_map_out = open(file_name_out, "w")
+    for i in range(8):
+        field_map_out.write(field_map_in.readline())
+    for block, lines in read_blocks(field_map_in, 2, False, chunk_size):
+        block_out = massage_block(block)
+        field_map_out.write(("%.12g %.12g %.12g %.12g %.12g %.12g\n"*\
+                                len(block_out)) % tuple(block_out.flatten()))
+    field_map_out.close()
 
 def main():
     """Main function"""
-    field_map_in = open("fieldmaps/TOSCA_cyli13.H")
-    for i in range(8):
-        line = field_map_in.readline()
-        print line,
-
-    current_word = None
-    block = []
-    while True:
-        line = field_map_in.readline()
-        words = line.split()
-        if current_word == None:
-            current_word = words[2]
-        if len(words) > 1 and words[2] == current_word: # still in same vertical step
-            block.append(line)
-        else: # new vertical step
-            print_block(block)
-            if line == '':
-                break
-            current_word = words[2] # vertical step
-            block = [line]
+    massage_field_map("fieldmaps/TOSCA_cyli13.H",
+                      "fieldmaps/TOSCA_cyli13_massaged.H")
 
 if __name__ == "__main__":
     main()
-
@@ -1 +1,6 @@
-from _opal_tracking import OpalTracking
+from _opal_tracking import OpalTracking, aperture_stop_condition
+from _probe_data import ProbeData, ProbeTrack, ProbeTail
+from _tracking_cache import TrackingCache
+from _tracking_pool import TrackingPool, TrackingJob
+from _stored_tracking import StoredTracking
+from _tracking_metrics import TrackingMetrics
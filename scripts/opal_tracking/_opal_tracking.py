@@ -22,12 +22,27 @@ import tempfile
 import subprocess
 import os
 import glob
+import re
+import time
+import StringIO
+
+import numpy
 
 from xboa import common
-from xboa.hit import Hit
 
 from xboa.tracking import TrackingBase 
 
+from _probe_data import ProbeData
+from _probe_data import ProbeTail
+from _probe_data import make_hit
+from _probe_data import find_probe_files
+from _probe_data import SIDECAR_SUFFIX
+from _tracking_pool import default_pool
+from _tracking_metrics import TrackingMetrics
+
+# columns of the beam arrays passed to OpalTracking._write_beam_file
+BEAM_COLUMNS = ('x', 'y', 'z', 'px', 'py', 'pz')
+
 class OpalTracking(TrackingBase):
     """
     Provides an interface to OPAL tracking routines for use by xboa.algorithms
@@ -45,10 +60,34 @@ class OpalTracking(TrackingBase):
           case all files matching the wildcards will be loaded
         - opal_path path to the OPAL executable
         - allow_duplicate_station when evaluates to False, OpalTracking will
-          discard duplicate stations on the same event
+          discard duplicate stations on the same event, i.e. crossings of a
+          station within duplicate_station_tolerance [ns] of an earlier
+          crossing of the same station
         - log_filename set to a string file name where OpalTracking will put the 
           terminal output from the opal command; if None, OpalTracking will make
           a temp file
+        - n_workers when greater than 1, track_many splits the hits into up to
+          n_workers shards and runs one OPAL process per shard concurrently
+        - shard_dir directory in which per-shard lattice, beam, log and PROBE
+          files are written; if None, a "shards" directory alongside the beam
+          file is used
+        - cache set to a TrackingCache to reuse the probe output of earlier
+          runs with identical lattice, beam, field maps and OPAL executable;
+          if None, OPAL is always run
+        - sidecar when evaluates to True, parsed probe data are stored in a
+          binary file next to each PROBE file and memory mapped on later reads,
+          unless the PROBE file is newer
+        - keep_probe_text when evaluates to False (and sidecar is True), PROBE
+          text files are removed once their sidecar has been written
+        - run_dir if not None, OPAL is run in this directory on a copy of the
+          lattice, so that PROBE files (and a relative output_filename) are
+          local to this OpalTracking; use when several jobs run concurrently
+        - verbose sets how much OpalTracking prints to the terminal: 0 for
+          nothing, 1 for log file names, 2 to also echo every hit written to
+          the beam file
+        - metrics TrackingMetrics that records the time spent in each phase of
+          every call; may be replaced by a TrackingMetrics shared with (or
+          given a metrics_filename by) the driver
         """
         self.beam_filename = beam_filename
         self.lattice_filename = lattice_filename
@@ -56,12 +95,19 @@ class OpalTracking(TrackingBase):
         self.opal_path = opal_path
         self.ref = reference_hit
         self.last = None
+        self._last_data = None # probe data behind last, before deduplication
         self.allow_duplicate_station = False
+        self.duplicate_station_tolerance = 1.
         self.do_tracking = True
         self.log_filename = log_filename
-        # clear any existing files (to prevent reloading "stale" files)
-        for a_file in glob.glob(self.output_name):
-            os.remove(a_file)
+        self.n_workers = 1
+        self.shard_dir = None
+        self.cache = None
+        self.sidecar = False
+        self.keep_probe_text = True
+        self.run_dir = None
+        self.verbose = 1
+        self.metrics = TrackingMetrics()
 
         
     def track_one(self, hit):
@@ -76,100 +122,480 @@ class OpalTracking(TrackingBase):
         """
         Track many hits through Opal
 
+        list_of_hits may be a list of xboa Hits, or for large distributions a
+        dict of numpy arrays keyed by "x", "y", "z", "px", "py", "pz" (in xboa
+        units), or an array with one row per particle holding those columns in
+        that order.
+
         Returns a list of lists of hits; each list of hits corresponds to a
         track, defined by probe "id" field. Output hits are sorted by time 
         within each event.
+
+        If n_workers is greater than 1, the hits are split into contiguous
+        shards which are tracked by concurrent OPAL processes; events are
+        renumbered so that the output matches a single OPAL run.
+
+        If cache is set, probe output is looked up in the cache before OPAL is
+        run and stored in the cache afterwards.
         """
+        self.metrics.start_call("track_many")
+        try:
+            return self._track_many(list_of_hits)
+        finally:
+            self.metrics.end_call()
+
+    def _track_many(self, list_of_hits):
+        """Track many hits; see track_many"""
+        beam = self.beam_to_array(list_of_hits)
+        if self.cache != None and self.do_tracking:
+            return self._track_many_cached(beam)
+        if self.n_workers > 1 and len(beam) > 1:
+            return self._track_many_sharded(beam)
         if self.do_tracking:
-            self._tracking(list_of_hits)
+            self._tracking(beam)
         hit_list_of_lists = self._read_probes()
         return hit_list_of_lists
 
-    def _tracking(self, list_of_hits):
-        if self.log_filename != None:
-            log_file = open(self.log_filename, "w")
-            fname = self.log_filename
+    def track_many_async(self, list_of_hits, pool = None):
+        """
+        Start tracking many hits through Opal in the background
+
+        - list_of_hits: hits to be tracked
+        - pool: TrackingPool that limits the number of concurrent jobs; if
+          None, a pool shared by all OpalTracking objects is used
+
+        Returns a TrackingJob; job.result() waits for OPAL and returns the same
+        list of lists of hits as track_many. Concurrent jobs must not share
+        lattice, beam or PROBE files, so use one OpalTracking per job (with
+        e.g. its own run directory).
+        """
+        if pool == None:
+            pool = default_pool()
+        return pool.track_many(self, list_of_hits)
+
+    def track_stream(self, list_of_hits, stop_condition = None,
+                     poll_interval = 0.5):
+        """
+        Track many hits through Opal, yielding hits while OPAL is running
+
+        - list_of_hits: hits to be tracked (see track_many)
+        - stop_condition: function called as stop_condition(hit, track) for
+          every hit read, where track is the list of hits read so far for
+          that event (including hit); if it returns True, OPAL is killed and
+          no further hits are yielded
+        - poll_interval: time [s] to wait between reads of the PROBE files
+
+        Hits are yielded as OPAL writes them; hits found in a single read are
+        yielded in time order. When the generator is exhausted, last holds the
+        (possibly partial) tracks in the same format as track_many.
+        """
+        self.metrics.start_call("track_stream")
+        log_file, fname = self._open_log(self.log_filename)
+        open(self.lattice_filename).close() # check that lattice exists
+        self._write_beam_file(self.beam_to_array(list_of_hits),
+                              self.beam_filename)
+        self._clear_probe_files(self._output_name())
+        tail = ProbeTail(self._output_name(), self.ref["mass"])
+        tracks_so_far = {} # maps event number to list of hits
+        data_list = [] # hits that have been yielded
+        data, n_yielded = ProbeData.load_files([], self.ref["mass"]), 0
+        stopped = False
+        lattice_filename, cwd = self._lattice_in_run_dir()
+        proc = self._start_opal(lattice_filename, log_file, cwd)
+        try:
+            while not stopped:
+                finished = self._wait_opal(proc, False) != None
+                with self.metrics.timer("read_probes"):
+                    data = tail.read()
+                    data = data[numpy.argsort(data["t"], kind="mergesort")]
+                n_yielded = 0
+                for row in data:
+                    hit = make_hit(row, self.ref)
+                    track = tracks_so_far.setdefault(hit["event_number"], [])
+                    track.append(hit)
+                    n_yielded += 1
+                    yield hit
+                    if stop_condition != None and stop_condition(hit, track):
+                        stopped = True
+                        break
+                data_list.append(data[:n_yielded])
+                data, n_yielded = data[:0], 0
+                if finished:
+                    break
+                if not stopped:
+                    time.sleep(poll_interval)
+        finally:
+            if self._wait_opal(proc, False) == None:
+                proc.kill()
+                stopped = True
+            self._wait_opal(proc)
+            data_list.append(data[:n_yielded]) # generator closed mid-read
+            probe_data = self._make_probe_data(numpy.concatenate(data_list))
+            self.last = probe_data.tracks()
+            self.metrics.count("hits_read", len(probe_data.data))
+            self.metrics.count("bytes_parsed", tail.bytes_read)
+            self.metrics.end_call()
+        if not stopped:
+            self._check_return_code(proc, fname)
+
+    def track_many_until(self, list_of_hits, stop_condition,
+                         poll_interval = 0.5):
+        """
+        Track many hits through Opal, killing OPAL as soon as stop_condition
+        returns True (see track_stream). Returns a list of lists of hits in
+        the same format as track_many.
+        """
+        for hit in self.track_stream(list_of_hits, stop_condition,
+                                     poll_interval):
+            pass
+        return self.last
+
+    def _track_many_cached(self, beam):
+        """
+        Track the beam array, reusing cached probe output if the same job has
+        been run before
+        """
+        open(self.lattice_filename).close() # check that lattice exists
+        self._write_beam_file(beam, self.beam_filename)
+        with self.metrics.timer("cache"):
+            key = self._cache_key()
+            data = self.cache.get(key)
+        if data is not None:
+            self.metrics.count("cache_hits", 1)
+            self.last = self._make_probe_data(data).tracks()
+            return self.last
+        if self.n_workers > 1 and len(beam) > 1:
+            self._track_many_sharded(beam)
+        else:
+            self._run_opal()
+            self._read_probes()
+        # store the probe data before duplicate stations are removed, so that
+        # a cache hit is deduplicated with the settings in force at the time
+        with self.metrics.timer("cache"):
+            self.cache.put(key, self._last_data)
+        return self.last
+
+    def _cache_key(self):
+        """
+        Cache key for the current lattice and beam file; the beam file name is
+        masked in the lattice so that identical jobs run in different
+        directories share a key
+        """
+        lattice_text = open(self.lattice_filename).read()
+        lattice_text = self._relocate_lattice(lattice_text, "__beamfile__")
+        return self.cache.key(lattice_text, self.beam_filename, self.opal_path,
+                              str(self.ref["mass"]))
+
+    def _tracking(self, beam):
+        open(self.lattice_filename).close() # check that lattice exists
+        self._write_beam_file(beam, self.beam_filename)
+        self._run_opal()
+
+    def _run_opal(self):
+        """Run OPAL on the lattice and beam file that have already been written"""
+        log_file, fname = self._open_log(self.log_filename)
+        self._clear_probe_files(self._output_name())
+        lattice_filename, cwd = self._lattice_in_run_dir()
+        with self.metrics.timer("opal"):
+            proc = self._start_opal(lattice_filename, log_file, cwd)
+            self._wait_opal(proc)
+        self._check_return_code(proc, fname)
+
+    def _track_many_sharded(self, beam):
+        """
+        Split the beam array into shards, track each shard in its own OPAL
+        process and merge the probe output back into a single list of lists
+        """
+        shards = self._make_shards(beam)
+        if self.do_tracking:
+            open(self.lattice_filename).close() # check that lattice exists
+            lattice_text = open(self.lattice_filename).read()
+            for shard in shards:
+                self._prepare_shard(shard, lattice_text)
+            with self.metrics.timer("opal"):
+                running = []
+                for shard in shards:
+                    running.append(self._start_shard(shard))
+                # wait for everything before raising so that no OPAL is
+                # orphaned
+                for proc, fname in running:
+                    self._wait_opal(proc)
+            for proc, fname in running:
+                self._check_return_code(proc, fname)
+        with self.metrics.timer("read_probes"):
+            data_list = []
+            stats = {}
+            for shard in shards:
+                file_list = find_probe_files(shard["output_name"])
+                data = ProbeData.load_files(file_list, self.ref["mass"],
+                                            self.sidecar, stats)
+                self._remove_probe_text(file_list)
+                data_list.append(data)
+            # offset event numbers in the merged copy; sidecar data are
+            # read-only
+            self._last_data = numpy.concatenate(data_list)
+            start = 0
+            for shard, data in zip(shards, data_list):
+                end = start+len(data)
+                self._last_data["event_number"][start:end] += shard["offset"]
+                start = end
+            probe_data = self._make_probe_data(self._last_data)
+            self.last = probe_data.tracks()
+        self.metrics.count("hits_read", len(probe_data.data))
+        self.metrics.count("bytes_parsed", stats.get("bytes_parsed", 0))
+        return self.last
+
+    def _make_shards(self, beam):
+        """
+        Split the beam array into at most n_workers contiguous shards; returns
+        a list of dicts describing the shard beam, event offset and files
+        """
+        shard_dir = self.shard_dir
+        if shard_dir == None:
+            beam_dir = os.path.dirname(self.beam_filename)
+            shard_dir = os.path.join(beam_dir, "shards")
+        n_shards = min(self.n_workers, len(beam))
+        n_per_shard, n_extra = divmod(len(beam), n_shards)
+        shards = []
+        offset = 0
+        for i in range(n_shards):
+            n_hits = n_per_shard
+            if i < n_extra:
+                n_hits += 1
+            a_dir = os.path.abspath(os.path.join(shard_dir, "shard_"+str(i)))
+            shards.append({
+                "beam":beam[offset:offset+n_hits],
+                "offset":offset,
+                "dir":a_dir,
+                "lattice_filename":os.path.join(a_dir, "lattice.tmp"),
+                "beam_filename":os.path.join(a_dir, "disttest.dat"),
+                "log_filename":os.path.join(a_dir, "log"),
+                # OPAL writes PROBE files in its working directory, which
+                # is the shard directory, even if output_name is absolute
+                "output_name":os.path.join(a_dir,
+                                           os.path.basename(self.output_name)),
+            })
+            offset += n_hits
+        return shards
+
+    def _prepare_shard(self, shard, lattice_text):
+        """Write the lattice copy and beam file for shard"""
+        try:
+            os.makedirs(shard["dir"])
+        except OSError:
+            pass
+        self._clear_probe_files(shard["output_name"])
+        with self.metrics.timer("lattice"):
+            fout = open(shard["lattice_filename"], "w")
+            fout.write(self._relocate_lattice(lattice_text,
+                                              shard["beam_filename"]))
+            fout.close()
+        self._write_beam_file(shard["beam"], shard["beam_filename"])
+
+    def _start_shard(self, shard):
+        """
+        Start OPAL in the shard directory (so that PROBE files land there);
+        returns a tuple of (process, log file name)
+        """
+        log_file, fname = self._open_log(shard["log_filename"])
+        proc = self._start_opal(shard["lattice_filename"], log_file,
+                                cwd=shard["dir"])
+        return proc, fname
+
+    def _relocate_lattice(self, lattice_text, beam_filename):
+        """
+        Rewrite quoted file names in lattice_text so that the lattice can be
+        run from a different working directory; the beam file is replaced by
+        beam_filename, other existing files are made absolute and anything
+        else (e.g. output file names) is left relative to the new directory
+        """
+        def relocate(match):
+            name = match.group(1)
+            if name == "":
+                return match.group(0)
+            if os.path.normpath(name) == os.path.normpath(self.beam_filename):
+                return '"'+beam_filename+'"'
+            if os.path.exists(name):
+                return '"'+os.path.abspath(name)+'"'
+            return match.group(0)
+        return re.sub('"([^"]*)"', relocate, lattice_text)
+
+    def _open_log(self, log_filename):
+        """Open the log file; returns a tuple of (file, file name)"""
+        if log_filename != None:
+            log_file = open(log_filename, "w")
+            fname = log_filename
         else:
             fname = tempfile.mkstemp()[1]
-            print "Using logfile ", fname
+            if self.verbose > 0:
+                print "Using logfile ", fname
             log_file = open(fname, 'w')
-        open(self.lattice_filename).close() # check that lattice exists
-        m, eV = common.units["m"], common.units["eV"]
-        fout = open(self.beam_filename, "w")
-        print >> fout, len(list_of_hits)
-        for hit in list_of_hits:
-            print 'tracking hit ...',
-            for key in 'x', 'y', 'z', 'px', 'py', 'pz':
-                print hit[key],
-            print
-            print '         ref ...',
-            for key in 'x', 'y', 'z', 'px', 'py', 'pz':
-                print self.ref[key],
-            print
-            x = (hit["x"]-self.ref["x"])/m
-            y = (hit["y"]-self.ref["y"])/m
-            z = (hit["z"]-self.ref["z"])/m
-            px = hit["px"]-self.ref["px"]
-            py = hit["pz"]-self.ref["pz"]
-            pz = hit["py"]-self.ref["py"] # NOTE! Wrong Units
-            print >> fout, x, px, z, pz, y, py
-        fout.close()
+        return log_file, fname
+
+    def beam_to_array(self, list_of_hits):
+        """
+        Convert hits to an array with one row per hit and columns x, y, z, px,
+        py, pz in xboa units (see track_many for the accepted formats)
+        """
+        if isinstance(list_of_hits, dict):
+            columns = [numpy.asarray(list_of_hits[key], dtype=numpy.float64) \
+                                                    for key in BEAM_COLUMNS]
+            return numpy.column_stack(columns).reshape(-1, len(BEAM_COLUMNS))
+        if isinstance(list_of_hits, numpy.ndarray):
+            return list_of_hits.astype(numpy.float64).reshape(-1,
+                                                             len(BEAM_COLUMNS))
+        beam = [[hit[key] for key in BEAM_COLUMNS] for hit in list_of_hits]
+        return numpy.array(beam, dtype=numpy.float64).reshape(-1,
+                                                             len(BEAM_COLUMNS))
+
+    def _write_beam_file(self, beam, beam_filename):
+        """
+        Write the beam array (see beam_to_array) to beam_filename in OPAL
+        fromfile format, relative to the reference hit, in one buffered write
+        """
+        with self.metrics.timer("beam_write"):
+            ref = numpy.array([self.ref[key] for key in BEAM_COLUMNS])
+            if self.verbose > 1:
+                for row in beam:
+                    print 'tracking hit ...', " ".join([str(x) for x in row])
+                    print '         ref ...', " ".join([str(x) for x in ref])
+            delta = beam-ref
+            delta[:, 0:3] /= common.units["m"]
+            # OPAL column order is x, px, z, pz, y, py; note that OPAL pz takes
+            # the xboa py and vice versa (NOTE! Wrong Units)
+            opal_beam = delta[:, [0, 3, 2, 4, 1, 5]]
+            buffer = StringIO.StringIO()
+            print >> buffer, len(beam)
+            numpy.savetxt(buffer, opal_beam, fmt="%.12g")
+            fout = open(beam_filename, "w")
+            fout.write(buffer.getvalue())
+            fout.close()
+        self.metrics.count("hits_written", len(beam))
+
+    def _lattice_in_run_dir(self):
+        """
+        Return a tuple of (lattice file name, working directory) for running
+        OPAL; if run_dir is set, a relocated copy of the lattice is written
+        there, otherwise the lattice is used as is in the current directory
+        """
+        if self.run_dir == None:
+            return self.lattice_filename, None
+        run_dir = os.path.abspath(self.run_dir)
         try:
-            os.remove(self.output_name) # make sure we don't load an old PROBE file
+            os.makedirs(run_dir)
         except OSError:
             pass
-        proc = subprocess.Popen([self.opal_path, self.lattice_filename],
+        with self.metrics.timer("lattice"):
+            lattice_text = open(self.lattice_filename).read()
+            lattice_filename = os.path.join(run_dir,
+                                    os.path.basename(self.lattice_filename))
+            if os.path.abspath(lattice_filename) == \
+               os.path.abspath(self.lattice_filename):
+                lattice_filename += ".run"
+            fout = open(lattice_filename, "w")
+            fout.write(self._relocate_lattice(lattice_text,
+                                          os.path.abspath(self.beam_filename)))
+            fout.close()
+        return lattice_filename, run_dir
+
+    def _output_name(self):
+        """
+        PROBE file name (or glob) as seen from the current directory, i.e.
+        relative to run_dir if output_name is a relative path
+        """
+        if self.run_dir == None:
+            return self.output_name
+        return os.path.join(self.run_dir, self.output_name)
+
+    def _start_opal(self, lattice_filename, log_file, cwd=None):
+        """Start OPAL on lattice_filename; returns the Popen object"""
+        proc = subprocess.Popen([self.opal_path, lattice_filename],
                                 stdout=log_file,
-                                stderr=subprocess.STDOUT)
-        proc.wait()
+                                stderr=subprocess.STDOUT,
+                                cwd=cwd)
+        return proc
+
+    def _wait_opal(self, proc, block = True):
+        """
+        Wait for OPAL (proc) to exit, or only check if block is False; returns
+        the return code, or None if OPAL is still running. The process is
+        reaped with os.wait4 so that its own CPU time is added to the "opal"
+        phase of metrics, whatever other jobs are running.
+        """
+        if proc.returncode != None:
+            return proc.returncode
+        options = 0
+        if not block:
+            options = os.WNOHANG
+        pid, status, usage = os.wait4(proc.pid, options)
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        self.metrics.add_cpu("opal", usage.ru_utime+usage.ru_stime)
+        return proc.returncode
+
+    def _check_return_code(self, proc, fname):
+        """Raise RuntimeError if OPAL (proc) failed"""
         if proc.returncode != 0:
             raise RuntimeError("OPAL quit with non-zero error code "+\
                                str(proc.returncode)+". Review the log file: "+\
                                str(fname))
 
-    def _remove_duplicate_stations(self, list_of_hit_dicts):
-        if self.allow_duplicate_station:
-            return list_of_hit_dicts
-        dict_of_hit_dicts = {} # temp mapping of station to hit_dict
-        for hit_dict in list_of_hit_dicts:
-            dict_of_hit_dicts[station] = hit_dict # overwrites if a duplicate
-        return dict_of_hit_dicts.values() # list of hit dicts
+    def _make_probe_data(self, data):
+        """
+        Make ProbeData from a PROBE_DTYPE array, removing duplicate stations
+        unless allow_duplicate_station is set
+        """
+        return ProbeData(data, self.ref, self.allow_duplicate_station,
+                         self.duplicate_station_tolerance)
 
     def _read_probes(self):
-        hit_dict_of_lists = {} # maps event number to a list of hit_dicts
-        # loop over files in the glob, read events and sort by event number
-        file_list = glob.glob(self.output_name)
-        for file_name in file_list:
-            fin = open(file_name)
-            fin.readline()
-            # go through file line by line reading hit data
-            for line in fin.readlines():
-                words = line.split()
-                hit_dict = {}
-                for key in "pid", "mass", "charge":
-                    hit_dict[key] = self.ref[key]
-                for i, key in enumerate(["x", "z", "y"]):
-                    hit_dict[key] = float(words[i+1])
-                for i, key in enumerate(["px", "pz", "py"]):
-                    hit_dict[key] = float(words[i+4])*self.ref["mass"]
-                event = int(words[7])
-                hit_dict["event_number"] = int(words[7])
-                hit_dict["station"] = int(words[8])
-                hit_dict["t"] = float(words[9])
-                hit_dict["x"] = (hit_dict["x"]**2.+hit_dict["z"]**2.)**0.5
-                hit_dict["z"] = 0.
-                if not event in hit_dict_of_lists:
-                    hit_dict_of_lists[event] = []
-                hit_dict_of_lists[event].append(Hit.new_from_dict(hit_dict, "energy"))
-        # convert from a dict of list of hits to a list of list of hits
-        # one list per event
-        # each list contains one hit per station
-        events = sorted(hit_dict_of_lists.keys())
-        hit_list_of_lists = [hit_dict_of_lists[ev] for ev in events]
-        # sort by time within each event
-        for i, hit_list in enumerate(hit_list_of_lists):
-            hit_list_of_lists[i] = sorted(hit_list, key = lambda hit: hit['t'])        
-        self.last = hit_list_of_lists
-        return hit_list_of_lists
+        """
+        Read the PROBE files matching output_name; returns a list of tracks,
+        one per event, sorted by event number. Each track is a ProbeTrack,
+        which behaves like a list of hits sorted by time.
+        """
+        stats = {}
+        with self.metrics.timer("read_probes"):
+            file_list = find_probe_files(self._output_name())
+            data = ProbeData.load_files(file_list, self.ref["mass"],
+                                        self.sidecar, stats)
+            self._last_data = data
+            probe_data = self._make_probe_data(data)
+            self._remove_probe_text(file_list)
+            self.last = probe_data.tracks()
+        self.metrics.count("hits_read", len(probe_data.data))
+        self.metrics.count("bytes_parsed", stats.get("bytes_parsed", 0))
+        return self.last
+
+    def _clear_probe_files(self, output_name):
+        """
+        Remove PROBE files, and their sidecars, matching output_name; makes
+        sure that we don't load an old PROBE file
+        """
+        for a_file in glob.glob(output_name)+\
+                      glob.glob(output_name+SIDECAR_SUFFIX):
+            os.remove(a_file)
+
+    def _remove_probe_text(self, file_list):
+        """Remove PROBE text files if sidecars are used in their place"""
+        if not self.sidecar or self.keep_probe_text:
+            return
+        for a_file in file_list:
+            try:
+                os.remove(a_file)
+            except OSError:
+                pass
 
+def aperture_stop_condition(r_min = 3900., r_max = 5500.):
+    """
+    Return a stop_condition for OpalTracking.track_stream that stops tracking
+    when any hit has radius ("x") outside of the range r_min to r_max [mm]
+    """
+    def stop_condition(hit, track):
+        return hit["x"] < r_min or hit["x"] > r_max
+    return stop_condition
 
@@ -0,0 +1,378 @@
+#This file is a part of xboa
+#
+#xboa is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#xboa is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with xboa in the doc folder.  If not, see
+#<http://www.gnu.org/licenses/>.
+
+"""
+\namespace _probe_data
+
+Columnar storage for OPAL PROBE output. Probe files are parsed in bulk into a
+numpy structured array; xboa Hits are only built when a track is indexed.
+"""
+
+import glob
+import os
+import tempfile
+
+import numpy
+
+from xboa.hit import Hit
+
+# columns of the structured array holding probe data, in xboa units
+PROBE_DTYPE = numpy.dtype([
+    ("x", numpy.float64),
+    ("y", numpy.float64),
+    ("z", numpy.float64),
+    ("px", numpy.float64),
+    ("py", numpy.float64),
+    ("pz", numpy.float64),
+    ("t", numpy.float64),
+    ("event_number", numpy.int64),
+    ("station", numpy.int64),
+])
+
+def empty_probe_data():
+    """Return a probe data array with no rows"""
+    return numpy.zeros((0,), dtype=PROBE_DTYPE)
+
+def parse_probe_text(text, mass):
+    """
+    Parse the body (i.e. without the header line) of a PROBE file
+    - text: string containing whitespace separated probe lines
+    - mass: particle mass used to convert OPAL beta gamma to momentum
+    Returns a structured array of PROBE_DTYPE. The OPAL horizontal plane is
+    converted to radius in "x", with "z" set to 0 (as xboa expects for a
+    ring).
+    """
+    lines = text.split("\n", 1)
+    n_columns = len(lines[0].split())
+    if n_columns == 0:
+        return empty_probe_data()
+    words = numpy.array(text.split())
+    if len(words) % n_columns != 0:
+        raise ValueError("PROBE data has ragged lines; expected "+\
+                         str(n_columns)+" columns per line")
+    columns = words.reshape(-1, n_columns)[:, 1:10].astype(numpy.float64)
+    data = numpy.zeros((columns.shape[0],), dtype=PROBE_DTYPE)
+    data["x"] = numpy.hypot(columns[:, 0], columns[:, 1])
+    data["y"] = columns[:, 2]
+    data["px"] = columns[:, 3]*mass
+    data["pz"] = columns[:, 4]*mass
+    data["py"] = columns[:, 5]*mass
+    data["event_number"] = columns[:, 6]
+    data["station"] = columns[:, 7]
+    data["t"] = columns[:, 8]
+    return data
+
+def load_probe_file(file_name, mass, sidecar = False, stats = None):
+    """
+    Load a PROBE file into a structured array; the first line is a header and
+    is skipped. See parse_probe_text for details.
+    - file_name: name of the PROBE file
+    - mass: particle mass used to convert OPAL beta gamma to momentum
+    - sidecar: if True, load from the binary sidecar file (file_name plus
+      SIDECAR_SUFFIX) when it is newer than the text file and was written
+      with the same mass, otherwise parse the text and write a new sidecar.
+      The text file need not exist if the sidecar does. Data loaded from a
+      sidecar are a read-only view of the memory map.
+    - stats: if not None, a dict in which "bytes_parsed" is incremented by the
+      number of bytes of text that were parsed
+    """
+    if not sidecar:
+        return parse_probe_text(_read_probe_body(file_name, stats), mass)
+    data = load_sidecar(file_name, mass)
+    if data is None:
+        data = parse_probe_text(_read_probe_body(file_name, stats), mass)
+        write_sidecar(file_name, data, mass)
+    return data
+
+def _read_probe_body(file_name, stats = None):
+    """Return the contents of a PROBE file, excluding the header line"""
+    fin = open(file_name)
+    fin.readline()
+    text = fin.read()
+    fin.close()
+    if stats != None:
+        stats["bytes_parsed"] = stats.get("bytes_parsed", 0)+len(text)
+    return text
+
+# appended to the PROBE file name to make the binary sidecar file name
+SIDECAR_SUFFIX = ".npy"
+
+def load_sidecar(file_name, mass):
+    """
+    Memory map the sidecar for PROBE file file_name. The first row of the
+    sidecar is a header, with event_number and station set to -1 and the
+    mass used to scale the momenta in "x"; the probe data follow. Returns
+    the probe data as a read-only view, or None if there is no sidecar, or
+    if it is older than the PROBE file or was written with a different mass
+    (i.e. stale).
+    """
+    sidecar_name = file_name+SIDECAR_SUFFIX
+    try:
+        sidecar_mtime = os.stat(sidecar_name).st_mtime
+    except OSError:
+        return None
+    try:
+        if os.stat(file_name).st_mtime > sidecar_mtime:
+            return None
+    except OSError:
+        pass # text file was removed; the sidecar is all we have
+    try:
+        data = numpy.load(sidecar_name, mmap_mode="r")
+    except (IOError, ValueError):
+        return None
+    if data.dtype != PROBE_DTYPE or len(data) == 0:
+        return None
+    header = data[0]
+    if header["event_number"] != -1 or header["station"] != -1 or \
+       header["x"] != mass:
+        return None
+    return data[1:]
+
+def write_sidecar(file_name, data, mass):
+    """
+    Write the sidecar for PROBE file file_name; data should be parsed with
+    mass (see load_sidecar). The file is replaced atomically, so that memory
+    maps of an earlier sidecar are left intact.
+    """
+    header = numpy.zeros((1,), dtype=PROBE_DTYPE)
+    header["x"] = mass
+    header["event_number"] = -1
+    header["station"] = -1
+    sidecar_dir = os.path.dirname(os.path.abspath(file_name))
+    file_handle, temp_name = tempfile.mkstemp(dir=sidecar_dir, suffix=".tmp")
+    fout = os.fdopen(file_handle, "wb")
+    numpy.save(fout, numpy.concatenate((header, data)))
+    fout.close()
+    os.rename(temp_name, file_name+SIDECAR_SUFFIX)
+
+def find_probe_files(output_name):
+    """
+    Return the sorted list of PROBE file names matching output_name, including
+    those for which only a sidecar remains
+    """
+    file_set = set(glob.glob(output_name))
+    for sidecar_name in glob.glob(output_name+SIDECAR_SUFFIX):
+        file_set.add(sidecar_name[:-len(SIDECAR_SUFFIX)])
+    return sorted(file_set)
+
+
+class ProbeData(object):
+    """
+    Probe data for many events, held as one structured array sorted by event
+    number and then by time. Each hit is also given a turn number, counting
+    crossings of the same station within an event from 0.
+    """
+    def __init__(self, data, reference, allow_duplicate_station = True,
+                 duplicate_tolerance = 1.):
+        """
+        Initialise the probe data
+        - data: structured array of PROBE_DTYPE, in any order
+        - reference: xboa Hit used to fill "pid", "mass" and "charge"
+        - allow_duplicate_station: if False, when an event crosses the same
+          station more than once within duplicate_tolerance only the first
+          crossing is kept
+        - duplicate_tolerance: time [ns] within which repeat crossings of the
+          same station are treated as duplicates
+        """
+        # group by event and station, in time order within each group
+        order = numpy.lexsort((data["t"], data["station"],
+                               data["event_number"]))
+        data = data[order]
+        new_group = numpy.ones((len(data),), dtype=bool)
+        new_group[1:] = (numpy.diff(data["event_number"]) != 0) | \
+                        (numpy.diff(data["station"]) != 0)
+        if not allow_duplicate_station:
+            keep = numpy.ones((len(data),), dtype=bool)
+            keep[1:] = new_group[1:] | \
+                       (numpy.diff(data["t"]) >= duplicate_tolerance)
+            data, new_group = data[keep], new_group[keep]
+        # turn is the position of each hit within its event/station group
+        index = numpy.arange(len(data))
+        group_start = numpy.maximum.accumulate(numpy.where(new_group, index, 0))
+        turns = index-group_start
+        # now sort by event and time
+        order = numpy.lexsort((data["t"], data["event_number"]))
+        self.data = data[order]
+        self.turns = turns[order]
+        self.ref = reference
+        events = self.data["event_number"]
+        # index of the first row of each event, plus one past the end
+        starts = numpy.flatnonzero(numpy.diff(events))+1
+        self.boundaries = numpy.concatenate(([0], starts, [len(events)]))
+        if len(events) == 0:
+            self.boundaries = numpy.zeros((1,), dtype=numpy.int64)
+
+    @classmethod
+    def from_files(cls, file_list, reference, event_offset = 0,
+                   sidecar = False, stats = None):
+        """
+        Load probe data from each file in file_list
+        - file_list: list of PROBE file names
+        - reference: xboa Hit giving "pid", "mass" and "charge"
+        - event_offset: integer added to the event number of every hit
+        - sidecar: if True, use binary sidecar files (see load_probe_file)
+        - stats: dict for load statistics (see load_probe_file)
+        """
+        data = cls.load_files(file_list, reference["mass"], sidecar, stats)
+        if event_offset != 0:
+            data = numpy.array(data) # sidecar data are read-only
+            data["event_number"] += event_offset
+        return cls(data, reference)
+
+    @classmethod
+    def load_files(cls, file_list, mass, sidecar = False, stats = None):
+        """
+        Load each file in file_list into a single structured array; a single
+        sidecar is returned without copying, so the result may be read-only
+        """
+        data_list = [load_probe_file(file_name, mass, sidecar, stats) \
+                                                  for file_name in file_list]
+        if len(data_list) == 0:
+            return empty_probe_data()
+        if len(data_list) == 1:
+            return data_list[0]
+        return numpy.concatenate(data_list)
+
+    def tracks(self):
+        """Return a list of ProbeTracks, one per event"""
+        track_list = []
+        for i in range(len(self.boundaries)-1):
+            start, end = self.boundaries[i], self.boundaries[i+1]
+            track_list.append(ProbeTrack(self.data[start:end], self.ref,
+                                         self.turns[start:end]))
+        return track_list
+
+
+class ProbeTrack(object):
+    """
+    One event's hits, held as a slice of a structured array. Behaves like a
+    list of xboa Hits sorted by time; Hits are built on first access and then
+    kept, so indexing the same element twice returns the same object.
+
+    Indexing with a tuple, track[station, turn], returns the hit for the
+    given crossing of a station; the lookup table is built on first use.
+    """
+    def __init__(self, data, reference, turns = None):
+        """
+        Initialise the track
+        - data: structured array of PROBE_DTYPE, already sorted by time
+        - reference: xboa Hit used to fill "pid", "mass" and "charge"
+        - turns: array holding the turn number of each hit; if None, hits are
+          numbered in time order for each station
+        """
+        self.data = data
+        self.ref = reference
+        if turns is None:
+            turns = ProbeData(data, reference).turns
+        self.turns = turns
+        self._hits = {}
+        self._station_turn_index = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self[self.index(*index)]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.data)))]
+        if index < 0:
+            index += len(self.data)
+        if index < 0 or index >= len(self.data):
+            raise IndexError("ProbeTrack index out of range")
+        if index not in self._hits:
+            self._hits[index] = self._make_hit(self.data[index])
+        return self._hits[index]
+
+    def index(self, station, turn):
+        """
+        Return the position in the track of the hit for station on turn;
+        raises KeyError if there is no such hit
+        """
+        if self._station_turn_index == None:
+            keys = zip(self.data["station"].tolist(), self.turns.tolist())
+            self._station_turn_index = dict(zip(keys, range(len(keys))))
+        return self._station_turn_index[(station, turn)]
+
+    def station_turn(self, index):
+        """Return the (station, turn) tuple of the hit at index"""
+        return int(self.data["station"][index]), int(self.turns[index])
+
+    def _make_hit(self, row):
+        """Build an xboa Hit from one row of probe data"""
+        return make_hit(row, self.ref)
+
+
+class ProbeTail(object):
+    """
+    Follows PROBE files while OPAL is still writing them. Each call to read()
+    returns the lines completed since the previous call.
+    """
+    def __init__(self, output_name, mass):
+        """
+        Initialise the tail
+        - output_name: PROBE file name; wildcards are allowed, and files that
+          appear after the tail was made are picked up on the next read()
+        - mass: particle mass used to convert OPAL beta gamma to momentum
+        """
+        self.output_name = output_name
+        self.mass = mass
+        self.offsets = {} # maps file name to number of bytes consumed
+        self.bytes_read = 0
+
+    def read(self):
+        """
+        Read complete lines appended to any of the PROBE files since the last
+        call; returns a structured array of PROBE_DTYPE
+        """
+        data_list = []
+        for file_name in sorted(glob.glob(self.output_name)):
+            offset = self.offsets.get(file_name, 0)
+            fin = open(file_name)
+            fin.seek(offset)
+            text = fin.read()
+            fin.close()
+            end = text.rfind("\n")+1 # leave partial lines for next time
+            text = text[:end]
+            self.offsets[file_name] = offset+end
+            self.bytes_read += end
+            if offset == 0 and end > 0:
+                text = text.split("\n", 1)[1] # skip the header line
+            if text.strip() != "":
+                data_list.append(parse_probe_text(text, self.mass))
+        if len(data_list) == 0:
+            return empty_probe_data()
+        return numpy.concatenate(data_list)
+
+
+def make_hit(row, reference):
+    """
+    Build an xboa Hit from one row of probe data
+    - row: one element of a PROBE_DTYPE structured array
+    - reference: xboa Hit used to fill "pid", "mass" and "charge"
+    """
+    hit_dict = {}
+    for key in "pid", "mass", "charge":
+        hit_dict[key] = reference[key]
+    for key in "x", "y", "z", "px", "py", "pz", "t":
+        hit_dict[key] = float(row[key])
+    hit_dict["event_number"] = int(row["event_number"])
+    hit_dict["station"] = int(row["station"])
+    return Hit.new_from_dict(hit_dict, "energy")
@@ -0,0 +1,45 @@
+#This file is a part of xboa
+#
+#xboa is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#xboa is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with xboa in the doc folder.  If not, see
+#<http://www.gnu.org/licenses/>.
+
+"""
+\namespace _stored_tracking
+"""
+
+from xboa.tracking import TrackingBase
+
+class StoredTracking(TrackingBase):
+    """
+    Replays tracks that have already been calculated, e.g. one event from a
+    multi-particle OPAL run, to xboa.algorithms that expect to do their own
+    tracking. The hits passed to track_one and track_many are ignored.
+    """
+    def __init__(self, list_of_tracks):
+        """
+        Initialise StoredTracking
+        - list_of_tracks is a list of lists of hits, as returned by
+          OpalTracking.track_many
+        """
+        self.tracks = list_of_tracks
+        self.last = None
+
+    def track_one(self, hit):
+        """Return the first stored track"""
+        return self.track_many([hit])[0]
+
+    def track_many(self, list_of_hits):
+        """Return the stored tracks, one per hit in list_of_hits"""
+        self.last = self.tracks[:len(list_of_hits)]
+        return self.last
@@ -0,0 +1,136 @@
+#This file is a part of xboa
+#
+#xboa is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#xboa is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with xboa in the doc folder.  If not, see
+#<http://www.gnu.org/licenses/>.
+
+"""
+\namespace _tracking_cache
+
+Content-addressed cache of OPAL probe output, so that identical tracking jobs
+are only run once.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy
+
+class TrackingCache(object):
+    """
+    Stores probe data on disk keyed by a hash of everything that goes into an
+    OPAL run: the lattice text, the beam file, any field maps referenced by
+    the lattice and the OPAL executable. The least recently used entries are
+    removed once the cache grows beyond max_size bytes.
+    """
+    def __init__(self, cache_dir = "tmp/tracking_cache/", max_size = 1e9):
+        """
+        Initialise the cache
+        - cache_dir: directory in which cached probe data are stored
+        - max_size: maximum total size of the cache [bytes]
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._file_hashes = {} # maps (name, size, mtime) to digest
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError:
+            pass
+
+    def key(self, lattice_text, beam_filename, opal_path, extra = ""):
+        """
+        Calculate the cache key for a tracking job
+        - lattice_text: the rendered lattice, as passed to OPAL
+        - beam_filename: name of the beam file
+        - opal_path: path to the OPAL executable
+        - extra: any other string that changes the stored data
+        Field maps are found from FMAPFN entries in lattice_text.
+        """
+        digest = hashlib.sha1()
+        digest.update(lattice_text)
+        digest.update(open(beam_filename).read())
+        for field_map in re.findall('FMAPFN\s*=\s*"([^"]*)"', lattice_text):
+            digest.update(self._hash_file(field_map))
+        digest.update(self._hash_file(opal_path))
+        digest.update(extra)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return the probe data stored under key, or None if there is none;
+        marks the entry as recently used
+        """
+        file_name = self._file_name(key)
+        try:
+            data = numpy.load(file_name)
+            os.utime(file_name, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Store the probe data array under key and evict old entries"""
+        file_handle, temp_name = tempfile.mkstemp(dir=self.cache_dir,
+                                                  suffix=".tmp")
+        fout = os.fdopen(file_handle, "wb")
+        numpy.save(fout, data)
+        fout.close()
+        os.rename(temp_name, self._file_name(key)) # atomic for parallel jobs
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue # removed by another job
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum([entry[1] for entry in entries])
+        for mtime, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_size -= size
+
+    def _file_name(self, key):
+        """Name of the file holding data for key"""
+        return os.path.join(self.cache_dir, key+".npy")
+
+    def _hash_file(self, file_name):
+        """
+        Return the sha1 digest of the contents of file_name; digests are kept
+        in memory until the file size or modification time changes
+        """
+        stat = os.stat(file_name)
+        stamp = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+        if stamp not in self._file_hashes:
+            digest = hashlib.sha1()
+            fin = open(file_name, "rb")
+            for block in iter(lambda: fin.read(1 << 20), ""):
+                digest.update(block)
+            fin.close()
+            self._file_hashes[stamp] = digest.hexdigest()
+        return self._file_hashes[stamp]
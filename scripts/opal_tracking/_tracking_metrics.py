@@ -0,0 +1,142 @@
+#This file is a part of xboa
+#
+#xboa is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#xboa is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with xboa in the doc folder.  If not, see
+#<http://www.gnu.org/licenses/>.
+
+"""
+\namespace _tracking_metrics
+"""
+
+import contextlib
+import json
+import resource
+import time
+
+# resource has no RUSAGE_THREAD in python 2; this is the Linux value
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+class TrackingMetrics(object):
+    """
+    Wall clock and CPU timings for each phase of OpalTracking calls, plus
+    counters such as the number of hits written and read.
+
+    Phases used by OpalTracking are "beam_write", "lattice", "opal",
+    "read_probes" and "cache"; drivers may add their own, e.g. "substitute".
+    CPU time is that of the calling thread, so that jobs timed in other
+    threads are not counted; the CPU time of each OPAL process is added to
+    the "opal" phase (see add_cpu) when it exits. Timings made between
+    calls are reported with the next call.
+    """
+    def __init__(self, metrics_filename = None):
+        """
+        Initialise the metrics
+        - metrics_filename: if not None, a JSON line describing each call is
+          appended to this file when the call ends
+        """
+        self.metrics_filename = metrics_filename
+        self.phases = {} # maps phase to totals {"wall", "cpu", "n_calls"}
+        self.counters = {}
+        self.n_calls = 0
+        self.last_call = None
+        self._call = self._new_call(None)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Context manager that adds the time spent inside it to phase"""
+        wall_start, cpu_start = time.time(), self._cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.time()-wall_start
+            cpu = self._cpu_time()-cpu_start
+            for phases in self.phases, self._call["phases"]:
+                totals = phases.setdefault(phase,
+                                           {"wall":0., "cpu":0., "n_calls":0})
+                totals["wall"] += wall
+                totals["cpu"] += cpu
+                totals["n_calls"] += 1
+
+    def add_cpu(self, phase, cpu):
+        """
+        Add cpu [s] to the CPU time of phase without counting a call, e.g.
+        for a child process that has exited
+        """
+        for phases in self.phases, self._call["phases"]:
+            totals = phases.setdefault(phase,
+                                       {"wall":0., "cpu":0., "n_calls":0})
+            totals["cpu"] += cpu
+
+    def count(self, counter, number):
+        """Add number to counter"""
+        for counters in self.counters, self._call["counters"]:
+            counters[counter] = counters.get(counter, 0)+number
+
+    def start_call(self, name):
+        """Mark the start of an OpalTracking call, e.g. "track_many" """
+        self._call["call"] = name
+        self._call["start"] = time.time()
+
+    def end_call(self):
+        """
+        Mark the end of an OpalTracking call; the call record is stored in
+        last_call and appended to metrics_filename if it is set
+        """
+        self._call["wall"] = time.time()-self._call["start"]
+        self.last_call = self._call
+        self.n_calls += 1
+        if self.metrics_filename != None:
+            fout = open(self.metrics_filename, "a")
+            print >> fout, json.dumps(self._call)
+            fout.close()
+        self._call = self._new_call(None)
+
+    def to_dict(self):
+        """Return the totals over all calls as a dict"""
+        return {
+            "n_calls":self.n_calls,
+            "phases":self.phases,
+            "counters":self.counters,
+        }
+
+    def merge(self, other):
+        """
+        Add the totals from another TrackingMetrics, e.g. one used by a job
+        running in another thread (a TrackingMetrics should only be used by
+        one call at a time)
+        """
+        for phase, other_totals in other.phases.iteritems():
+            totals = self.phases.setdefault(phase,
+                                            {"wall":0., "cpu":0., "n_calls":0})
+            for key in totals:
+                totals[key] += other_totals[key]
+        for counter, number in other.counters.iteritems():
+            self.counters[counter] = self.counters.get(counter, 0)+number
+        self.n_calls += other.n_calls
+        if other.last_call != None:
+            self.last_call = other.last_call
+
+    def _new_call(self, name):
+        """Empty record for one call"""
+        return {"call":name, "start":time.time(), "phases":{}, "counters":{}}
+
+    def _cpu_time(self):
+        """
+        CPU time of the calling thread, or of this process where per thread
+        times are not available
+        """
+        try:
+            usage = resource.getrusage(RUSAGE_THREAD)
+        except (ValueError, resource.error):
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime+usage.ru_stime
@@ -0,0 +1,121 @@
+#This file is a part of xboa
+#
+#xboa is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#xboa is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with xboa in the doc folder.  If not, see
+#<http://www.gnu.org/licenses/>.
+
+"""
+\namespace _tracking_pool
+
+Run many independent tracking jobs at the same time. The heavy lifting is done
+by OPAL subprocesses, so jobs are driven from threads with a limit on the
+number of jobs running at once.
+"""
+
+import multiprocessing
+import sys
+import threading
+
+class TrackingJob(object):
+    """
+    Handle on a tracking job submitted to a TrackingPool; result() waits for
+    the job and returns whatever the tracking call returned
+    """
+    def __init__(self):
+        """Initialise an unfinished job"""
+        self._finished = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        """Return True if the job has finished (successfully or not)"""
+        return self._finished.is_set()
+
+    def result(self, timeout = None):
+        """
+        Wait for the job to finish and return its result
+        - timeout: maximum time to wait [s]; if None, wait forever
+        Raises RuntimeError on timeout; if the job raised an exception, it is
+        raised again here with the original traceback.
+        """
+        if not self._finished.wait(timeout):
+            raise RuntimeError("Timed out waiting for tracking job")
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class TrackingPool(object):
+    """
+    Runs tracking calls in background threads, with at most max_concurrent
+    running at once. Each job should use its own tracking object (and hence
+    its own lattice, beam and PROBE files).
+    """
+    def __init__(self, max_concurrent = None):
+        """
+        Initialise the pool
+        - max_concurrent: maximum number of jobs running at once; if None, use
+          the number of CPUs
+        """
+        if max_concurrent == None:
+            max_concurrent = multiprocessing.cpu_count()
+        self.max_concurrent = max_concurrent
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+
+    def submit(self, function, *args):
+        """
+        Call function(*args) in the background; returns a TrackingJob
+        """
+        job = TrackingJob()
+        thread = threading.Thread(target=self._run, args=(job, function, args))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def track_many(self, tracking, list_of_hits):
+        """
+        Call tracking.track_many(list_of_hits) in the background; returns a
+        TrackingJob whose result is the usual list of lists of hits
+        """
+        return self.submit(tracking.track_many, list_of_hits)
+
+    def track_one(self, tracking, hit):
+        """
+        Call tracking.track_one(hit) in the background; returns a TrackingJob
+        whose result is the usual list of hits
+        """
+        return self.submit(tracking.track_one, hit)
+
+    def gather(self, job_list):
+        """Wait for every job in job_list; returns a list of results in order"""
+        return [job.result() for job in job_list]
+
+    def _run(self, job, function, args):
+        """Run function(*args) in a thread, storing the result in job"""
+        self._semaphore.acquire()
+        try:
+            job._result = function(*args)
+        except Exception:
+            job._exc_info = sys.exc_info()
+        finally:
+            self._semaphore.release()
+            job._finished.set()
+
+_default_pool = None
+
+def default_pool():
+    """Return a TrackingPool shared by all callers, sized by CPU count"""
+    global _default_pool
+    if _default_pool == None:
+        _default_pool = TrackingPool()
+    return _default_pool
@@ -3,30 +3,22 @@ Plot the closed orbit as a function of energy
 """
 
 import sys
-import json
 
 import xboa.Common as common
 
+from lattice_table import load_lattice_table
+from plot_queue import wait_for_user
+
 def load_file():
-    fin = open("output/find_closed_orbit.ref")
-    data_out = {}
-    for line in fin.readlines():
-        one_data = json.loads(line)
-        e_ref = one_data[0]
-        if len(one_data) > 2 and abs(one_data[2][1]) < 1e-9:
-            data_out[e_ref] = one_data[2:]
-        elif len(one_data) > 1:
-            data_out[e_ref] = one_data[1:]
-        else:
-            data_out[e_ref] = []
-    print data_out.keys()
-    return data_out
+    data = load_lattice_table("output/find_closed_orbit.ref")
+    print data.energy_list
+    return data
 
 def plot_closed_orbit(data):
     print "\nclosed orbit",
     sys.stdout.flush()
-    energy_list = [energy/1e3 for energy in data.keys()]
-    x_list = [data[key][0][0] for key in data.keys()]
+    energy_list = (data.energy/1e3).tolist()
+    x_list = data.radius_array.tolist()
     canvas = common.make_root_canvas("closed orbit")
     hist, graph = common.make_root_graph("closed orbit", energy_list, "Kinetic Energy [GeV]", x_list, "Radial position [mm]")
     hist.Draw()
@@ -38,16 +30,11 @@ def plot_closed_orbit(data):
     canvas.Print("plots/closed_orbit.root")
     
 
-def _get_mean_tof(data):
-    tof_list = [data[i+1][1]-data[i][1] for i, item in enumerate(data[1:])]
-    tof_mean = sum(tof_list)/len(tof_list)
-    return tof_mean
-
 def plot_tof(data):
     print "\nfrequency",
     sys.stdout.flush()
-    energy_list = [(energy-11.)/1e3 for energy in data.keys()]
-    f_list = [1./_get_mean_tof(data[key]) for key in data.keys()]
+    energy_list = ((data.energy-11.)/1e3).tolist()
+    f_list = data.frequency_array.tolist()
     print f_list
     canvas = common.make_root_canvas("frequency")
     hist, graph = common.make_root_graph("frequency", energy_list, "Kinetic Energy [GeV]", f_list, "Frequency [GHz]")
@@ -65,4 +52,4 @@ def main():
 
 if __name__ == "__main__":
     main()
-    raw_input()
+    wait_for_user()
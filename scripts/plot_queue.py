@@ -0,0 +1,180 @@
+"""
+Render plots away from the tracking loop. Driver scripts send plot data to a
+PlotQueue; the canvases are drawn and printed by a background worker, or the
+jobs are written to a file and rendered afterwards by running
+
+    python scripts/plot_queue.py <job_file>
+"""
+
+import atexit
+import json
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+
+import numpy
+
+class PlotQueue(object):
+    def __init__(self, mode = "process", job_filename = "plots/plot_jobs.json"):
+        """
+        Queue of plots to be rendered with ROOT in batch mode.
+
+        - mode: "process" to render in a background worker process (or a
+                thread, if this process is itself a daemonic worker, which
+                may not have children); "defer" to append each job as a json
+                line to job_filename for rendering later with render_file;
+                "inline" to render immediately
+        - job_filename: file used to store jobs in "defer" mode
+        """
+        if mode not in ["process", "defer", "inline"]:
+            raise ValueError("Did not recognise PlotQueue mode "+str(mode))
+        self.mode = mode
+        self.job_filename = job_filename
+        self._queue = None
+        self._worker = None
+        self._pid = None # process that started the worker
+
+    def scatter(self, name, x_list, x_label, y_list, y_label, title = "",
+                ellipse = None, formats = ("png", "root")):
+        """
+        Queue a scatter plot of y against x
+        - name: file name of the plot, without extension
+        - x_list, y_list: lists of floats to plot
+        - x_label, y_label: axis labels
+        - title: title of the plot
+        - ellipse: if not None, a tuple of (centre, matrix); the ellipse
+                   (u-centre)^T matrix^-1 (u-centre) = const that passes
+                   through the mean of the points is drawn over the points
+        - formats: extensions of the files to print
+        """
+        job = {
+            "name":name,
+            "title":title,
+            "x":[float(x) for x in x_list],
+            "x_label":x_label,
+            "y":[float(y) for y in y_list],
+            "y_label":y_label,
+            "ellipse":None,
+            "formats":list(formats),
+        }
+        if ellipse != None:
+            job["ellipse"] = [numpy.array(ellipse[0]).flatten().tolist(),
+                              numpy.array(ellipse[1]).tolist()]
+        self.put(job)
+
+    def put(self, job):
+        """Queue a json serialisable plot job, as made by scatter"""
+        if self.mode == "inline":
+            render(job)
+        elif self.mode == "defer":
+            fout = open(self.job_filename, "a")
+            print >> fout, json.dumps(job)
+            fout.close()
+        else:
+            if self._worker == None or self._pid != os.getpid():
+                self._start_worker()
+            self._queue.put(job)
+
+    def close(self):
+        """Wait for the worker to render every queued plot"""
+        if self._worker == None or self._pid != os.getpid():
+            return # worker belongs to a parent process, e.g. after fork
+        self._queue.put(None)
+        self._worker.join()
+        self._queue, self._worker = None, None
+
+    def _start_worker(self):
+        """Start the worker process (or thread) that renders the plots"""
+        if multiprocessing.current_process().daemon:
+            self._queue = Queue.Queue()
+            self._worker = threading.Thread(target=_render_loop,
+                                            args=(self._queue,))
+        else:
+            self._queue = multiprocessing.Queue()
+            self._worker = multiprocessing.Process(target=_render_loop,
+                                                   args=(self._queue,))
+        self._worker.daemon = True
+        self._worker.start()
+        self._pid = os.getpid()
+
+def render(job):
+    """Draw the plot described by job and print it to file"""
+    import ROOT
+    import xboa.common as common
+    ROOT.gROOT.SetBatch(True)
+    canvas = common.make_root_canvas(job["title"])
+    hist, graph = common.make_root_graph(job["title"], job["x"],
+                                         job["x_label"], job["y"],
+                                         job["y_label"])
+    hist.SetTitle(job["title"])
+    hist.Draw()
+    graph.SetMarkerStyle(4)
+    graph.Draw("p")
+    if job["ellipse"] != None and len(job["x"]) > 0:
+        centre = numpy.array(job["ellipse"][0])
+        matrix = numpy.array(job["ellipse"][1])
+        delta = numpy.array([job["x"], job["y"]]).transpose()-centre
+        contour = numpy.mean(numpy.sum(numpy.dot(delta,
+                                       numpy.linalg.inv(matrix))*delta, axis=1))
+        function = common.make_root_ellipse_function(centre.tolist(),
+                                                     matrix.tolist(),
+                                                     [contour],
+                                                     hist.GetXaxis().GetXmin(),
+                                                     hist.GetXaxis().GetXmax(),
+                                                     hist.GetYaxis().GetXmin(),
+                                                     hist.GetYaxis().GetXmax())
+        function.Draw("same")
+    canvas.Update()
+    for format in job["formats"]:
+        canvas.Print(job["name"]+"."+format)
+    canvas.Close()
+
+def render_file(job_filename):
+    """Render every job in a file written by a PlotQueue in "defer" mode"""
+    for line in open(job_filename):
+        render(json.loads(line))
+
+def _render_loop(queue):
+    """Render jobs from queue until None is received"""
+    while True:
+        job = queue.get()
+        if job == None:
+            break
+        try:
+            render(job)
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+
+_default_queue = None
+
+def default_queue():
+    """
+    Return a PlotQueue shared by all callers in this process; queued plots
+    are finished when the process exits normally
+    """
+    global _default_queue
+    if _default_queue == None:
+        _default_queue = PlotQueue()
+        atexit.register(_default_queue.close)
+    return _default_queue
+
+def wait_for_user():
+    """
+    Wait for the user to press return, so that interactive canvases stay
+    open; returns immediately if there is no terminal or ROOT is in batch
+    mode, so that batch jobs finish unattended. Queued plots are finished
+    first.
+    """
+    if _default_queue != None:
+        _default_queue.close()
+    root = sys.modules.get("ROOT")
+    if root != None and root.gROOT.IsBatch():
+        return
+    if not sys.stdin.isatty():
+        return
+    raw_input()
+
+if __name__ == "__main__":
+    render_file(sys.argv[1])
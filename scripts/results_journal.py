@@ -0,0 +1,86 @@
+"""
+Append-only journal of sweep results, so that long closed orbit and tune
+sweeps can be restarted without repeating completed points
+"""
+
+import json
+import os
+
+class ResultsJournal(object):
+    def __init__(self, file_name):
+        """
+        Journal of results, stored as one json line per result in file_name.
+        Each result is keyed by a dict of the parameters that produced it
+        (e.g. energy, nturns, step size); a point is only skipped on restart
+        if every parameter matches. Existing entries are loaded on
+        construction; a partially written last line (e.g. from a crash) is
+        ignored.
+
+        - file_name: name of the journal file; created if it does not exist
+        """
+        self.file_name = file_name
+        self.entries = {} # maps key to result
+        self._load()
+
+    def key(self, parameters):
+        """Return the journal key for a dict of parameters"""
+        return json.dumps(parameters, sort_keys=True)
+
+    def get(self, parameters):
+        """Return the result stored for parameters, or None"""
+        return self.entries.get(self.key(parameters))
+
+    def done(self, parameters):
+        """Return True if a result is stored for parameters"""
+        return self.key(parameters) in self.entries
+
+    def record(self, parameters, result):
+        """
+        Append a result to the journal; the line is flushed to disk before
+        returning, so that it survives the job being killed
+        - parameters: dict of parameters; must be json serialisable
+        - result: the result; must be json serialisable
+        """
+        line = json.dumps({"parameters":parameters, "result":result},
+                          sort_keys=True)
+        fout = open(self.file_name, "a")
+        if fout.tell() > 0 and not self._ends_with_newline():
+            fout.write("\n") # terminate a partial line left by a crash
+        fout.write(line+"\n")
+        fout.flush()
+        os.fsync(fout.fileno())
+        fout.close()
+        self.entries[self.key(parameters)] = result
+
+    def results(self, **parameters):
+        """
+        Return a list of (parameters, result) for every entry whose
+        parameters include all of the given keyword parameters, e.g.
+        journal.results(nturns=5.1, step=10)
+        """
+        matches = []
+        for key, result in self.entries.iteritems():
+            entry = json.loads(key)
+            if all([entry.get(name) == value \
+                                    for name, value in parameters.iteritems()]):
+                matches.append((entry, result))
+        return matches
+
+    def _ends_with_newline(self):
+        """Return True if the journal file ends with a newline"""
+        fin = open(self.file_name, "rb")
+        fin.seek(-1, os.SEEK_END)
+        last = fin.read(1)
+        fin.close()
+        return last == "\n"
+
+    def _load(self):
+        """Load existing entries from file_name"""
+        if not os.path.exists(self.file_name):
+            return
+        for line in open(self.file_name):
+            try:
+                entry = json.loads(line)
+                self.entries[self.key(entry["parameters"])] = entry["result"]
+            except (ValueError, KeyError, TypeError):
+                print "Ignoring bad line in", self.file_name, repr(line[:80])
@@ -0,0 +1,147 @@
+"""
+Tune analysis of turn-by-turn data for many particles at once. Each function
+takes arrays u, up of shape (n_particles, n_turns) holding the phase space
+coordinates (e.g. x, px) of each particle on each turn, and works on all of
+the particles together with numpy.
+
+The signal is first normalised using the ellipse matched to each particle's
+own turn-by-turn data, so that the motion is a circle z = U - i UP = exp(i phi)
+with phi advancing by 2 pi tune each turn. Tunes are returned in [0, 1).
+Methods are
+- "dphi": mean phase advance per turn
+- "fft": Hann windowed FFT with interpolation between frequency bins
+- "naff": FFT estimate refined by maximising the overlap of the windowed
+  signal with exp(2 pi i tune n) (Laskar's NAFF, first frequency only)
+"""
+
+import numpy
+
+METHODS = ["dphi", "fft", "naff"]
+
+def normalise(u, up):
+    """
+    Transform u, up to the complex normalised signal z = U - i UP using the
+    Twiss parameters of the ellipse matched to each particle; the mean of
+    each particle's signal (e.g. the closed orbit) is subtracted first.
+    Particles with no motion give a signal of zeros.
+    - u, up: arrays of shape (n_particles, n_turns)
+    Returns a complex array of shape (n_particles, n_turns)
+    """
+    u = numpy.array(u, dtype=numpy.float64, ndmin=2)
+    up = numpy.array(up, dtype=numpy.float64, ndmin=2)
+    u = u-numpy.mean(u, axis=1)[:, numpy.newaxis]
+    up = up-numpy.mean(up, axis=1)[:, numpy.newaxis]
+    var_u = numpy.mean(u*u, axis=1)
+    var_up = numpy.mean(up*up, axis=1)
+    cov = numpy.mean(u*up, axis=1)
+    emittance = numpy.sqrt(numpy.clip(var_u*var_up-cov*cov, 0., None))
+    good = emittance > 0.
+    emittance[~good] = 1.
+    beta = (var_u/emittance)[:, numpy.newaxis]
+    alpha = (-cov/emittance)[:, numpy.newaxis]
+    beta[~good] = 1.
+    norm_u = u/numpy.sqrt(beta)
+    norm_up = (alpha*u+beta*up)/numpy.sqrt(beta)
+    z = norm_u-1j*norm_up
+    z[~good] = 0.
+    return z
+
+def dphi_tune(z):
+    """
+    Tune from the mean phase advance per turn of the normalised signal z;
+    returns a tuple of arrays (tune, error) where error is the standard error
+    on the mean phase advance
+    """
+    dphi = numpy.angle(z[:, 1:]*numpy.conj(z[:, :-1])) % (2.*numpy.pi)
+    tune = numpy.mean(dphi, axis=1)/2./numpy.pi
+    error = numpy.std(dphi, axis=1)/2./numpy.pi/numpy.sqrt(dphi.shape[1])
+    return tune, error
+
+def fft_tune(z):
+    """
+    Tune from the peak of the Hann windowed FFT of the normalised signal z,
+    interpolated between bins using the ratio of the peak and its largest
+    neighbour; returns an array of tunes
+    """
+    n_turns = z.shape[1]
+    spectrum = numpy.abs(numpy.fft.fft(z*_hann(n_turns), axis=1))
+    rows = numpy.arange(z.shape[0])
+    peak = numpy.argmax(spectrum, axis=1)
+    left = spectrum[rows, (peak-1) % n_turns]
+    right = spectrum[rows, (peak+1) % n_turns]
+    centre = numpy.where(spectrum[rows, peak] > 0., spectrum[rows, peak], 1.)
+    # for a Hann window, the bin offset is (2 ratio - 1)/(ratio + 1)
+    ratio = numpy.maximum(left, right)/centre
+    offset = (2.*ratio-1.)/(ratio+1.)
+    offset = numpy.where(right > left, offset, -offset)
+    return ((peak+offset)/n_turns) % 1.
+
+def naff_tune(z, tolerance = 1e-12, max_iterations = 100):
+    """
+    Tune from the frequency that maximises the overlap between the Hann
+    windowed normalised signal z and exp(2 pi i tune n), starting from the
+    fft_tune estimate and refined by successive parabolic steps
+    - z: normalised signal
+    - tolerance: stop refining when the step size is below tolerance
+    - max_iterations: maximum number of refinement steps
+    Returns an array of tunes
+    """
+    n_turns = z.shape[1]
+    signal = z*_hann(n_turns)
+    tune = fft_tune(z)
+    step = 0.5/n_turns
+    for i in range(max_iterations):
+        if step < tolerance:
+            break
+        below = _overlap(signal, tune-step)
+        centre = _overlap(signal, tune)
+        above = _overlap(signal, tune+step)
+        curvature = below-2.*centre+above
+        # vertex of the parabola through the three points, where it has a
+        # maximum; otherwise step towards the larger neighbour
+        safe = numpy.where(curvature < 0., curvature, -1.)
+        shift = numpy.where(curvature < 0., 0.5*(below-above)/safe,
+                            numpy.sign(above-below))
+        tune = tune+numpy.clip(shift, -1., 1.)*step
+        step *= 0.5
+    return tune % 1.
+
+def find_tunes(u, up, method = "naff"):
+    """
+    Find the tune of each particle
+    - u, up: arrays of shape (n_particles, n_turns) of turn-by-turn data
+    - method: one of METHODS
+    Returns a tuple of arrays (tune, error). For "dphi" the error is the
+    standard error on the mean phase advance; for "fft" and "naff" it is the
+    difference between the tunes found from the first and second half of the
+    turns. Particles with no motion have a tune and error of nan.
+    """
+    if method not in METHODS:
+        raise ValueError("Tune method "+str(method)+" should be one of "+\
+                         str(METHODS))
+    z = normalise(u, up)
+    if method == "dphi":
+        tune, error = dphi_tune(z)
+    else:
+        finder = {"fft":fft_tune, "naff":naff_tune}[method]
+        half = z.shape[1]/2
+        error = numpy.abs(finder(z[:, :half])-finder(z[:, half:2*half]))
+        error = numpy.minimum(error, 1.-error) # tunes either side of 0 or 1
+        tune = finder(z)
+    no_motion = numpy.all(z == 0., axis=1)
+    tune[no_motion] = numpy.nan
+    error[no_motion] = numpy.nan
+    return tune, error
+
+def _hann(n_turns):
+    """Hann window of length n_turns"""
+    return 0.5-0.5*numpy.cos(2.*numpy.pi*numpy.arange(n_turns)/n_turns)
+
+def _overlap(signal, tune):
+    """
+    Magnitude of the overlap of each row of signal with exp(2 pi i tune n),
+    for an array of tunes (one per row)
+    """
+    turns = numpy.arange(signal.shape[1])
+    phase = numpy.exp(-2j*numpy.pi*tune[:, numpy.newaxis]*turns)
+    return numpy.abs(numpy.sum(signal*phase, axis=1))
@@ -2,6 +2,7 @@ import json
 import numpy
 import math
 import xboa.common
+from lattice_table import load_lattice_table
 
 def load_summary_data(filename, columns, units):
     fin = open(filename)
@@ -25,16 +26,16 @@ def load_json_file(filename):
     data = [json.loads(line) for line in fin.readlines()]
     return data
 
-def make_summary_data(closed_orbits, cell_tunes, ring_tunes):
+def make_summary_data(lattice_table, cell_tunes, ring_tunes):
     all_data = {}
-    for co in closed_orbits:
+    closed_orbits = zip(lattice_table.energy_list,
+                        lattice_table.radius_array.tolist(),
+                        lattice_table.tof_array.tolist())
+    for kinetic_energy, position, turn_time in closed_orbits:
         summary_data_dict = {}
         mass = xboa.common.pdg_pid_to_mass[2212]
-        kinetic_energy = co[0]
         energy = kinetic_energy+mass
         momentum = (energy**2.-mass**2.)**0.5
-        position = co[1][0]
-        turn_time = co[3][1]
         summary_data_dict["kinetic_energy"] = kinetic_energy
         summary_data_dict["p"] = momentum
         summary_data_dict["closed_orbit"] = position
@@ -86,10 +87,10 @@ def main():
     columns = ["kinetic_energy", "p", "qx", "qy", "Qx", "Qy", "closed_orbit", "mean_radius", "cell_time", "turn_time"]
     units = ["MeV", "MeV/c", "", "", "", "", "m", "m", "mus", "mus"]
     zgoubi_data = load_summary_data("/home/cr67/MAUS/work/kurri/ads-ffag/maus/magnets_only/zgoubi_summary_tracking_data.dat", columns, units)
-    closed_orbits = load_json_file("closed_orbits_all.ref")
+    lattice_table = load_lattice_table("closed_orbits_all.ref")
     ring_tunes = load_json_file("ring_tunes_nturns=100.1_stepsize=10.0_poly_order=1_smooth_order=1_all.out")
     cell_tunes = []
-    opal_data = make_summary_data(closed_orbits, cell_tunes, ring_tunes)
+    opal_data = make_summary_data(lattice_table, cell_tunes, ring_tunes)
     for a_opal in opal_data:
         print a_opal
         for a_zgoubi in zgoubi_data: